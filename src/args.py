@@ -40,11 +40,39 @@ class Parser(object):
         parser.add_argument('--arch_weight_decay', type=float, default=1e-3, help='weight decay for arch encoding')
         parser.add_argument('--unrolled', action='store_true', default=False,
                             help='use one-step unrolled validation loss')
+        parser.add_argument('--hvp', choices=['finite', 'exact', 'reuse'], default='finite',
+                            help='Hessian-vector product of the unrolled step: finite differences, double backward, '
+                                 'or double backward through the graph of the training gradients')
 
         # one-shot model options
         parser.add_argument('--init_channels', type=int, default=16, help='num of init channels')
         parser.add_argument('--layers', type=int, default=3, help='total number of layers')
         parser.add_argument('--nodes', type=int, default=3, help='number of intermediate nodes per cell')
+        parser.add_argument('--share_trunk', action='store_true', default=False,
+                            help='share one spatial-temporal trunk among the attention candidates of an edge')
+        parser.add_argument('--partial_channel', type=int, default=1,
+                            help='send 1/k of the channels through the candidates of an edge, 1 disables it')
+        parser.add_argument('--sample_ops', type=int, default=0,
+                            help='candidates drawn per edge and step with Gumbel top-k sampling, 0 evaluates all of them')
+        parser.add_argument('--tau_max', type=float, default=10, help='initial Gumbel softmax temperature')
+        parser.add_argument('--tau_min', type=float, default=0.1, help='final Gumbel softmax temperature')
+        parser.add_argument('--prune_epochs', type=str, default='',
+                            help='comma separated epochs at which the weakest candidates of every edge are removed')
+        parser.add_argument('--prune_num', type=int, default=1, help='candidates removed per edge at a pruning epoch')
+        parser.add_argument('--prune_threshold', type=float, default=0.,
+                            help='remove candidates with a softmax weight below this value, every epoch if no --prune_epochs')
+        parser.add_argument('--fuse_stem', action='store_true', default=False,
+                            help='run the three input streams of the stem as one branch of grouped convolutions')
+        parser.add_argument('--freeze_stem_epoch', type=int, default=-1,
+                            help='epoch from which the stem is frozen and its features are cached, -1 never freezes it')
+        parser.add_argument('--stem_weights', type=str, default='',
+                            help='checkpoint with pretrained stem weights, the stem is frozen from the start')
+        parser.add_argument('--stem_cache', choices=['none', 'ram', 'memmap'], default='ram',
+                            help='where the features of a frozen stem are cached')
+        parser.add_argument('--parallel_ops', type=int, default=0,
+                            help='threads running the candidate ops of a node concurrently, 0 or 1 runs them sequentially')
+        parser.add_argument('--grad_checkpoint', choices=['none', 'cell', 'mixedop'], default='none',
+                            help='recompute the activations of each cell or mixed op during backward instead of storing them')
 
         # augmentation options
         parser.add_argument('--cutout', action='store_true', default=False, help='use cutout')
@@ -72,6 +100,19 @@ class Parser(object):
         parser.add_argument('--extra_rollback_epochs', type=int, default=0,
                             help='number of extra rollback epochs when deciding to increse regularization')
         parser.add_argument('--compute_hessian', action='store_true', default=False, help='compute or not Hessian')
+        parser.add_argument('--probe_size', type=int, default=0,
+                            help='samples of the fixed training and validation batches of the Hessian, 0 uses --batch_size')
+        parser.add_argument('--ev_method', choices=['full', 'power', 'lanczos'], default='full',
+                            help='dominant Hessian eigenvalue from the full Hessian, or from Hessian-vector products '
+                                 'by power iteration or Lanczos')
+        parser.add_argument('--ev_iters', type=int, default=20,
+                            help='maximum Hessian-vector products of --ev_method power and lanczos')
+        parser.add_argument('--ev_tol', type=float, default=1e-3,
+                            help='relative change of the eigenvalue at which power and lanczos stop')
+        parser.add_argument('--async_hessian', action='store_true', default=False,
+                            help='compute the Hessian eigenvalues in a background thread while the search goes on')
+        parser.add_argument('--analysis_lag', type=int, default=1,
+                            help='reported epochs the --async_hessian eigenvalues may lag the search, 0 waits for each')
         parser.add_argument('--max_weight_decay', type=float, default=243e-4, help='maximum weight decay')
         parser.add_argument('--mul_factor', type=float, default=3.0, help='multiplication factor')
 
@@ -99,6 +140,41 @@ class Parser(object):
                             help='starting id of checkpoint to load for ev calculation')
         parser.add_argument('--disable_cuda', action='store_true', default=False, help='disable cuda')
 
+        # benchmarking
+        parser.add_argument('--bench', choices=['parallel_ops', 'derived', 'hvp', 'export', 'stream', 'incremental', 'server', 'server_errors'], default='parallel_ops',
+                            help='what benchmark.py measures')
+        parser.add_argument('--arch', type=str, default='AnimalNAS', help='genotype in genotypes.py')
+        parser.add_argument('--bench_threads', type=str, default='1,2,4,8',
+                            help='comma separated thread counts to benchmark')
+        parser.add_argument('--bench_batch_sizes', type=str, default='1,8,32,128,256',
+                            help='comma separated batch sizes of the export benchmark')
+        parser.add_argument('--bench_hvp_modes', type=str, default='finite,exact,reuse',
+                            help='comma separated --hvp modes of the hvp benchmark')
+        parser.add_argument('--bench_repeats', type=int, default=5, help='timed repetitions per setting')
+        parser.add_argument('--stream_cameras', type=int, default=8, help='pose streams of the stream benchmark')
+        parser.add_argument('--stream_stride', type=int, default=10, help='frames between two predictions of a stream')
+        parser.add_argument('--stream_frames', type=int, default=200, help='frames per stream of the stream benchmark')
+
+        parser.add_argument('--bench_clients', type=int, default=16, help='concurrent clients of the server benchmark')
+        parser.add_argument('--bench_requests', type=int, default=256, help='requests of the server benchmark')
+
+        # serving
+        parser.add_argument('--server_host', type=str, default='127.0.0.1', help='address server.py listens on')
+        parser.add_argument('--server_port', type=int, default=8000, help='port server.py listens on')
+        parser.add_argument('--max_batch', type=int, default=32, help='samples per batch of the server')
+        parser.add_argument('--max_delay_ms', type=float, default=10, help='time a request waits for a batch')
+        parser.add_argument('--server_workers', type=int, default=2, help='batches the server runs concurrently')
+
+        # offline timelines
+        parser.add_argument('--recording', type=str, default='', help='json directory or .npy array to label')
+        parser.add_argument('--timeline_csv', type=str, default='timeline.csv', help='per-frame labels of the recording')
+        parser.add_argument('--timeline_batch', type=int, default=256, help='windows per forward pass of timeline.py')
+
+        # quantization
+        parser.add_argument('--calib_batches', type=int, default=200, help='valid batches to calibrate int8 with')
+        parser.add_argument('--quant_backend', choices=['x86', 'fbgemm', 'qnnpack'], default='x86',
+                            help='quantized engine of quantize.py')
+
         # visualization
         parser.add_argument('--x', type=str, default='-1:1:301', help='A string with format xmin:x_max:xnum')
         parser.add_argument('--y', type=str, default='-1:1:301', help='A string with format ymin:y_max:ynum')
@@ -156,11 +232,29 @@ class Helper(Parser):
             "arch_learning_rate",
             "arch_weight_decay",
             "unrolled",
+            "hvp",
             "init_channels",
             "layers",
             "nodes",
+            "share_trunk",
+            "partial_channel",
+            "sample_ops",
+            "tau_max",
+            "tau_min",
+            "prune_epochs",
+            "prune_num",
+            "prune_threshold",
+            "grad_checkpoint",
+            "parallel_ops",
+            "fuse_stem",
+            "freeze_stem_epoch",
+            "stem_weights",
+            "stem_cache",
             "cutout_length",
             "report_freq_hessian",
+            "ev_method",
+            "async_hessian",
+            "analysis_lag",
             "early_stop",
             "window",
             "es_start_epoch",
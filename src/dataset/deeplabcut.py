@@ -1,6 +1,64 @@
 from pathlib import Path
 import json
 
+
+def normalize_keypoints(keypoints):
+    """ Pose and score of one DeepLabCut skeleton, (x, y, score) per joint.
+
+    Keypoints beyond the image border (x > 670, y < 3.5) get a zero score and
+    the coordinates are scaled by the extent of the skeleton. They are shifted
+    by joint 4, which is normalized in place, so the joints after it keep their
+    origin. Streaming inputs must go through the same steps as the training
+    data.
+
+    Returns:
+        coordinates (list): x0, y0, x1, y1, ...
+        score (list): one score per joint
+    """
+    score , coordinates  = [], []
+    for i in range(0, len(keypoints), 3):
+        keypoints[i] = float(keypoints[i])
+        keypoints[i+1] = float(keypoints[i+1])
+        keypoints[i+2] = float(keypoints[i+2])
+        if keypoints[i+1] < 3.5 and keypoints[i] > 670:
+            keypoints[i+2] = 0
+        coordinates += [float(keypoints[i]), float(keypoints[i + 1])]
+        score += [float(keypoints[i + 2])]
+
+    max_x = coordinates[0]
+    min_x = coordinates[0]
+    max_y = coordinates[1]
+    min_y = coordinates[1]
+    for j in range(0,len(coordinates),2):
+        if coordinates[j] >= max_x and  coordinates[j]<670:
+            max_x = coordinates[j]
+        if coordinates[j] <= min_x:
+            min_x = coordinates[j]
+        if coordinates[j+1] >= max_y:
+            max_y = coordinates[j+1]
+        if coordinates[j+1] <= min_y  and coordinates[j+1]>3.5:
+            min_y = coordinates[j+1]
+    frame_x = max_x - min_x
+    frame_y = max_y - min_y
+    for j in range(0, len(coordinates), 2):
+        coordinates[j] = (coordinates[j] - coordinates[8])/frame_x
+        coordinates[j+1] = (coordinates[j+1] - coordinates[9])/frame_y #以动物中心点为原点，归一化
+    return coordinates, score
+
+
+def iter_keypoints(snippets_dir):
+    """ (frame_index, keypoints) of the DeepLabCut json files of a recording in
+    frame order, one file at a time. keypoints is the list of the first
+    skeleton of the frame, None if the frame has none.
+    """
+    paths = sorted(Path(snippets_dir).glob('*.json'), key=lambda path: int(path.stem.split('_')[-1]))
+    for path in paths:
+        with open(str(path)) as f:
+            data = json.load(f)
+        people = data[0]['people']
+        yield int(path.stem.split('_')[-1]), people[0]['pose_keypoints_3d'] if people else None
+
+
 def json_pack(snippets_dir, label, label_index):
     sequence_info = []
     p = Path(snippets_dir)
@@ -12,37 +70,8 @@ def json_pack(snippets_dir, label, label_index):
         data = json.load(open(json_path))
         skeletons = []
         for person in data[0]['people']:
-            score , coordinates  = [], []
             skeleton = {}
-            keypoints = person['pose_keypoints_3d']
-            #print(keypoints)
-            for i in range(0, len(keypoints), 3):
-                keypoints[i] = float(keypoints[i])
-                keypoints[i+1] = float(keypoints[i+1])
-                keypoints[i+2] = float(keypoints[i+2])
-                if keypoints[i+1] < 3.5 and keypoints[i] > 670:
-                    keypoints[i+2] = 0
-                coordinates += [float(keypoints[i]), float(keypoints[i + 1])]
-                score += [float(keypoints[i + 2])]
-
-            max_x = coordinates[0]
-            min_x = coordinates[0]
-            max_y = coordinates[1]
-            min_y = coordinates[1]
-            for j in range(0,len(coordinates),2):
-                if coordinates[j] >= max_x and  coordinates[j]<670:
-                    max_x = coordinates[j]
-                if coordinates[j] <= min_x:
-                    min_x = coordinates[j]
-                if coordinates[j+1] >= max_y:
-                    max_y = coordinates[j+1]
-                if coordinates[j+1] <= min_y  and coordinates[j+1]>3.5:
-                    min_y = coordinates[j+1]
-            frame_x = max_x - min_x
-            frame_y = max_y - min_y
-            for j in range(0, len(coordinates), 2):
-                coordinates[j] = (coordinates[j] - coordinates[8])/frame_x
-                coordinates[j+1] = (coordinates[j+1] - coordinates[9])/frame_y #以动物中心点为原点，归一化
+            coordinates, score = normalize_keypoints(person['pose_keypoints_3d'])
             skeleton['pose'] = coordinates
             skeleton['score'] = score
             skeletons += [skeleton]
@@ -54,15 +54,7 @@ class Preprocess_Feeder(Dataset):
 
 
     def multi_input(self, data):
-        C, T, V, M = data.shape
-        data_new = np.zeros((3, C, T, V, M))
-        data_new[0, :, :, :, :] = data
-        for i in range(len(self.conn)):
-            data_new[1, :, :, i, :] = data[:, :, i, :] - data[:, :, self.conn[i], :]
-        for i in range(T - 1):
-            data_new[2, :, i, :, :] = data[:, i + 1, :, :] - data[:, i, :, :]
-        data_new[2, :, T - 1, :, :] = 0
-        return data_new
+        return multi_input(data, self.conn)
 
 
     def get_k_fold_data(self, k, i, data, label, name):
@@ -93,4 +85,17 @@ class Preprocess_Feeder(Dataset):
                 label_train = label_train + label_part
                 name_train = name_train + name_part
 
-        return data_train, label_train, name_train, data_test, label_test, name_test
\ No newline at end of file
+        return data_train, label_train, name_train, data_test, label_test, name_test
+
+
+def multi_input(data, conn):
+    # (C, T, V, M) -> (I, C, T, V, M), joint, bone and motion streams
+    C, T, V, M = data.shape
+    data_new = np.zeros((3, C, T, V, M))
+    data_new[0, :, :, :, :] = data
+    for i in range(len(conn)):
+        data_new[1, :, :, i, :] = data[:, :, i, :] - data[:, :, conn[i], :]
+    for i in range(T - 1):
+        data_new[2, :, i, :, :] = data[:, i + 1, :, :] - data[:, i, :, :]
+    data_new[2, :, T - 1, :, :] = 0
+    return data_new
@@ -4,10 +4,67 @@ import torch.nn as nn
 from numpy.linalg import eigvals
 from torch.autograd import Variable
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+
+from architect import _grads_or_zeros, flat_parameters, weight_gradients, unrolled_parameters, \
+    functional_loss, finite_difference_hvp, exact_hvp
+
+import sys
+sys.path.append("..")
+from args import beta_decay_scheduler
 
 
 def _concat(xs):
-  return torch.cat([x.view(-1) for x in xs])
+  return torch.cat([x.reshape(-1) for x in xs])
+
+
+def power_iteration(hvp, v, iters=20, tol=1e-3):
+    """ Eigenvalue of largest magnitude of a symmetric matrix given by its
+    products hvp(v), as the Rayleigh quotient of the power iteration.
+
+    Returns:
+        eigenvalue, unit eigenvector and number of products
+    """
+    v = v / v.norm()
+    ev = None
+    for i in range(iters):
+        hv = hvp(v)
+        new_ev = torch.dot(v, hv).item()
+        v = hv / hv.norm()
+        converged = ev is not None and abs(new_ev - ev) <= tol*abs(new_ev)
+        ev = new_ev
+        if converged:
+            break
+    return ev, v, i + 1
+
+
+def lanczos(hvp, v, iters=20, tol=1e-3):
+    """ Largest eigenvalue of a symmetric matrix given by its products hvp(v),
+    from the tridiagonal matrix of the Lanczos iteration. The basis is fully
+    reorthogonalized, which is cheap for the few hundred alphas.
+
+    Returns:
+        eigenvalue, unit eigenvector (Ritz vector) and number of products
+    """
+    basis = [v / v.norm()]
+    diagonal, off_diagonal = [], []
+    ev = None
+    while True:
+        w = hvp(basis[-1])
+        diagonal.append(torch.dot(basis[-1], w).item())
+        for q in basis:
+            w = w - torch.dot(q, w)*q
+        T = np.diag(diagonal) + np.diag(off_diagonal, 1) + np.diag(off_diagonal, -1)
+        evs, vectors = np.linalg.eigh(T)
+        converged = ev is not None and abs(evs[-1] - ev) <= tol*abs(evs[-1])
+        ev = evs[-1]
+        beta = w.norm().item()
+        if converged or len(diagonal) == iters or beta <= 1e-8*abs(ev):
+            break
+        off_diagonal.append(beta)
+        basis.append(w / beta)
+    ritz = sum(float(c)*q for c, q in zip(vectors[:, -1], basis))
+    return float(ev), ritz / ritz.norm(), len(diagonal)
 
 class Analyzer(object):
 
@@ -15,24 +72,13 @@ class Analyzer(object):
         self.network_momentum = args.momentum
         self.network_weight_decay = args.weight_decay
         self.model = model
+        self.hvp = args.hvp
         self.weight_decay = args.arch_weight_decay
         self.hessian = None
         self.grads = None
-
-    def _compute_unrolled_model(self, input, target, eta, network_optimizer):
-        loss = self.model._loss(input, target)
-        theta = _concat(self.model.parameters()).data
-        try:
-            moment = _concat(network_optimizer.state[v]['momentum_buffer'] for
-                             v in
-                             self.model.parameters()).mul_(self.network_momentum)
-        except:
-            moment = torch.zeros_like(theta)
-        dtheta = _concat(torch.autograd.grad(loss,
-                                             self.model.parameters())).data + self.network_weight_decay*theta
-
-        unrolled_model = self._construct_model_from_theta(theta.sub(eta, moment+dtheta))
-        return unrolled_model
+        # dominant eigenvector of the last compute_eigenvalue, the start of the next one
+        self.eigenvector = None
+        self.ev_iterations = 0
 
     def _backward_step(self, input_valid, target_valid, create_graph):
         loss = self.model._loss(input_valid, target_valid)
@@ -41,56 +87,35 @@ class Analyzer(object):
     def _backward_step_unrolled(self, input_train, target_train, input_valid,
                                 target_valid, eta, network_optimizer,
                                 create_graph):
-        unrolled_model = self._compute_unrolled_model(input_train,
-                                                      target_train, eta,
-                                                      network_optimizer)
-        unrolled_loss = unrolled_model._loss(input_valid, target_valid)
-
-        unrolled_loss.backward(create_graph=create_graph)
-        dalpha = [v.grad for v in unrolled_model.arch_parameters()]
-        vector = [v.grad.data for v in unrolled_model.parameters()]
-        implicit_grads = self._hessian_vector_product(vector, input_train, target_train)
+        reuse = self.hvp == 'reuse'
+        train_grads = weight_gradients(self.model, input_train, target_train, create_graph=reuse)
+        params = unrolled_parameters(self.model, train_grads, eta,
+                                     network_optimizer, self.network_momentum,
+                                     self.network_weight_decay)
+        unrolled_loss = functional_loss(self.model, params, input_valid, target_valid)
+
+        arch_parameters = self.model.arch_parameters()
+        grads = _grads_or_zeros(unrolled_loss, arch_parameters + list(params.values()),
+                                create_graph=create_graph)
+        dalpha = grads[:len(arch_parameters)]
+        vector = flat_parameters(self.model).flatten([g.detach() for g in grads[len(arch_parameters):]])
+        implicit_grads = self._hessian_vector_product(vector, input_train, target_train,
+                                                      train_grads if reuse else None)
 
         for g, ig in zip(dalpha, implicit_grads):
-            g.data.sub_(eta, ig.data)
+            g.data.sub_(eta*ig.data)
 
-        for v, g in zip(self.model.arch_parameters(), dalpha):
+        for v, g in zip(arch_parameters, dalpha):
             if v.grad is None:
                 v.grad = Variable(g.data)
             else:
                 v.grad.data.copy_(g.data)
 
-    def _construct_model_from_theta(self, theta):
-        model_new = self.model.new()
-        model_dict = self.model.state_dict()
-
-        params, offset = {}, 0
-        for k, v in self.model.named_parameters():
-            v_length = np.prod(v.size())
-            params[k] = theta[offset: offset+v_length].view(v.size())
-            offset += v_length
-
-        assert offset == len(theta)
-        model_dict.update(params)
-        model_new.load_state_dict(model_dict)
-        return model_new.cuda()
-
-    def _hessian_vector_product(self, vector, input, target, r=1e-2):
-        R = r / _concat(vector).norm()
-        for p, v in zip(self.model.parameters(), vector):
-            p.data.add_(R, v)
-        loss = self.model._loss(input, target)
-        grads_p = torch.autograd.grad(loss, self.model.arch_parameters())
-
-        for p, v in zip(self.model.parameters(), vector):
-            p.data.sub_(2*R, v)
-        loss = self.model._loss(input, target)
-        grads_n = torch.autograd.grad(loss, self.model.arch_parameters())
-
-        for p, v in zip(self.model.parameters(), vector):
-            p.data.add_(R, v)
-
-        return [(x-y).div_(2*R) for x, y in zip(grads_p, grads_n)]
+    def _hessian_vector_product(self, vector, input, target, grads=None, r=1e-2):
+        # vector has the layout of flat_parameters(self.model)
+        if self.hvp == 'finite':
+            return finite_difference_hvp(self.model, vector, input, target, r)
+        return exact_hvp(self.model, vector, input, target, grads)
 
 
     def compute_dw(self, input_train, target_train, input_valid, target_valid,
@@ -104,7 +129,9 @@ class Analyzer(object):
         else:
             self._backward_step(input_valid, target_valid, False)
 
-        self.grads = [v.grad + self.weight_decay*v for v in self.model.arch_parameters()]
+        # alphas the loss does not use have no gradient
+        self.grads = [(torch.zeros_like(v) if v.grad is None else v.grad) + self.weight_decay*v
+                      for v in self.model.arch_parameters()]
         return self.grads
 
     def compute_Hw(self, input_train, target_train, input_valid, target_valid,
@@ -112,9 +139,40 @@ class Analyzer(object):
         self.zero_grads(self.model.parameters())
         self.zero_grads(self.model.arch_parameters())
         loss = self.model._loss(input_valid, target_valid)
-        self.hessian = self._hessian(loss, self.model.arch_parameters())
+        self.hessian = self._hessian(loss, self.model.arch_parameters(), allow_unused=True)
         return self.hessian
 
+    def compute_eigenvalue(self, input_valid, target_valid, method='lanczos', iters=20, tol=1e-3):
+        """ Largest eigenvalue of the Hessian of compute_Hw, from Hessian-vector
+        products instead of the full Hessian. One forward and backward pass
+        builds the graph of the gradient, then every product is one more
+        backward through it. The iteration starts from the eigenvector of the
+        previous call, so it needs few products while the alphas change slowly.
+
+        Args:
+            method (str): 'lanczos', or 'power' for the eigenvalue of largest
+                magnitude
+            iters (int): maximum number of Hessian-vector products
+            tol (float): relative change of the eigenvalue at which it stops
+        """
+        self.zero_grads(self.model.parameters())
+        self.zero_grads(self.model.arch_parameters())
+        arch_parameters = self.model.arch_parameters()
+        loss = self.model._loss(input_valid, target_valid)
+        grads = self.gradient(loss, arch_parameters, create_graph=True)
+
+        def hvp(v):
+            return self.gradient(torch.dot(grads, v), arch_parameters, retain_graph=True) + self.weight_decay*v
+
+        v = self.eigenvector
+        if v is None or v.numel() != grads.numel():
+            # first call, or the alphas were pruned
+            v = torch.randn(grads.numel(), dtype=grads.dtype, device=grads.device)
+        solver = lanczos if method == 'lanczos' else power_iteration
+        ev, v, self.ev_iterations = solver(hvp, v.detach(), iters, tol)
+        self.eigenvector = v.detach()
+        return ev
+
     def compute_eigenvalues(self):
         if self.hessian is None:
             raise ValueError
@@ -156,6 +214,9 @@ class Analyzer(object):
         for i, inp in enumerate(inputs):
             [grad] = torch.autograd.grad(outputs, inp, create_graph=True,
                                          allow_unused=allow_unused)
+            if grad is None:
+                # alphas the loss does not use, e.g. those of the reduction cells, have zero rows
+                grad = torch.zeros_like(inp)
             grad = grad.contiguous().view(-1) + self.weight_decay*inp.view(-1)
 
             for j in range(inp.numel()):
@@ -175,3 +236,92 @@ class Analyzer(object):
         return out
 
 
+def analyse(analyser, probe, epoch, method='full', iters=20, tol=1e-3):
+    """ Dominant eigenvalue of the architecture Hessian on the probe batches of
+    utils.probe_batch, with the full Hessian or with analyser.compute_eigenvalue.
+
+    Returns:
+        eigenvalue, and the entry of derivatives_<task_id>.json
+    """
+    (input, target), (input_valid, target_valid) = probe
+    # the analysis is not unrolled, it needs no learning rate or network optimizer
+    if method == 'full':
+        H = analyser.compute_Hw(input, target, input_valid, target_valid, None, None, False)
+    g = analyser.compute_dw(input, target, input_valid, target_valid, None, None, False)
+    g = torch.cat([x.view(-1) for x in g])
+
+    if method == 'full':
+        state = {'epoch': epoch,
+                 'H': H.cpu().data.numpy().tolist(),
+                 'g': g.cpu().data.numpy().tolist(),
+                 }
+        ev = max(eigvals(H.cpu().data.numpy()))
+    else:
+        ev = analyser.compute_eigenvalue(input_valid, target_valid, method, iters, tol)
+        state = {'epoch': epoch,
+                 'ev': ev,
+                 'eigenvector': analyser.eigenvector.cpu().numpy().tolist(),
+                 'hvps': analyser.ev_iterations,
+                 'g': g.cpu().data.numpy().tolist(),
+                 }
+    return ev, state
+
+
+class BackgroundAnalyzer(object):
+    """ Runs analyse on snapshots of the search model in a background thread,
+    so the search goes on while the Hessian of a reported epoch is computed.
+    The autograd and tensor operations of the thread release the GIL.
+
+    A snapshot is a copy of the model, weights and alphas, taken when it is
+    submitted, with the auxiliary skip weight of beta_decay_scheduler at that
+    time, since the search steps the scheduler before the snapshot is analysed. Beyond max_lag pending snapshots, collect waits for the oldest
+    result, so the eigenvalues and early stopping decisions lag the search by
+    at most max_lag reported epochs. max_lag 0 waits for every result.
+
+    Args:
+        args: search arguments, --ev_method, --ev_iters and --ev_tol are used
+        max_lag (int): snapshots that may be pending
+    """
+    def __init__(self, args, max_lag=1):
+        self.args = args
+        self.max_lag = max_lag
+        self.pool = ThreadPoolExecutor(1)
+        # epoch: (future, genotype), in the order of submission
+        self.pending = {}
+        # the eigenvector of a snapshot is the start of the next one
+        self.eigenvector = None
+
+    def _analyse(self, epoch, model, probe):
+        analyser = Analyzer(self.args, model)
+        analyser.eigenvector = self.eigenvector
+        ev, state = analyse(analyser, probe, epoch, self.args.ev_method, self.args.ev_iters,
+                            self.args.ev_tol)
+        self.eigenvector = analyser.eigenvector
+        return ev, state
+
+    def submit(self, epoch, model, probe, genotype):
+        snapshot = deepcopy(model)
+        snapshot.set_decay_rate(beta_decay_scheduler.decay_rate)
+        self.pending[epoch] = (self.pool.submit(self._analyse, epoch, snapshot, probe), genotype)
+
+    def collect(self, max_pending=None):
+        """ Results that are ready, in epoch order, after waiting until at most
+        max_pending (default max_lag) snapshots are left. Errors of the
+        analysis are raised here.
+
+        Returns:
+            list of (epoch, eigenvalue, state, genotype), see analyse
+        """
+        max_pending = self.max_lag if max_pending is None else max_pending
+        results = []
+        while self.pending:
+            epoch, (future, genotype) = next(iter(self.pending.items()))
+            if len(self.pending) <= max_pending and not future.done():
+                break
+            ev, state = future.result()
+            del self.pending[epoch]
+            results.append((epoch, ev, state, genotype))
+        return results
+
+    def close(self):
+        self.pool.shutdown()
@@ -2,10 +2,171 @@ import torch
 import numpy as np
 import torch.nn as nn
 from torch.autograd import Variable
+from torch.func import functional_call
 
 
 def _concat(xs):
-  return torch.cat([x.view(-1) for x in xs])
+  return torch.cat([x.reshape(-1) for x in xs])
+
+
+def _grads_or_zeros(loss, xs, create_graph=False):
+  # parameters the loss does not depend on, e.g. skipped candidates, get zero gradients
+  grads = torch.autograd.grad(loss, xs, allow_unused=True, create_graph=create_graph)
+  return [torch.zeros_like(x) if g is None else g for x, g in zip(xs, grads)]
+
+
+class FlatParameters(object):
+  """ Parameters whose data are views into one contiguous buffer per dtype (the
+  graph edge importances are float64), so the weights, their updates and
+  perturbations are a few vector operations instead of a copy or a loop over
+  the parameters. Vectors with this layout are lists with one tensor per
+  buffer.
+
+  Replacing the data of a parameter (pruning, .cuda(), load_state_dict with
+  assign=True) breaks the views, flat_parameters then builds new buffers.
+  """
+  def __init__(self, named_parameters):
+    named = list(named_parameters)
+    dtypes = sorted({p.dtype for _, p in named}, key=str)
+    # parameters grouped by dtype, in model order within a group
+    self.groups = [[(k, p) for k, p in named if p.dtype == dtype] for dtype in dtypes]
+    self.params = [p for group in self.groups for _, p in group]
+    self.data = [_concat([p.data for _, p in group]) for group in self.groups]
+    for group, buffer in zip(self.groups, self.data):
+      offset = 0
+      for _, p in group:
+        p.data = buffer[offset:offset+p.numel()].view_as(p)
+        offset += p.numel()
+    self._ids = [id(p) for _, p in named]
+    self._ptrs = [p.data_ptr() for p in self.params]
+    self._momentum = None
+    self._momentum_ptrs = None
+
+  def matches(self, params):
+    return [id(p) for p in params] == self._ids and [p.data_ptr() for p in self.params] == self._ptrs
+
+  def flatten(self, tensors):
+    # vectors of per-parameter tensors given in the order of self.params, None gives zeros
+    tensors, out = list(tensors), []
+    for group in self.groups:
+      chunk, tensors = tensors[:len(group)], tensors[len(group):]
+      out.append(_concat([torch.zeros_like(p) if t is None else t for (_, p), t in zip(group, chunk)]))
+    return out
+
+  def momentum(self, optimizer):
+    # SGD momentum buffers of self.params as vectors. The buffers are replaced by views into
+    # them once, SGD updates them in place, so later steps read them without a copy. Missing
+    # buffers, e.g. of weights without gradients so far, become zeros, which SGD without
+    # dampening updates like a new buffer
+    buffers = [optimizer.state.get(p, {}).get('momentum_buffer') for p in self.params]
+    ptrs = [None if b is None else b.data_ptr() for b in buffers]
+    if ptrs != self._momentum_ptrs:
+      self._momentum = self.flatten(buffers)
+      for p, view in zip(self.params, self.views(self._momentum).values()):
+        optimizer.state[p]['momentum_buffer'] = view
+      self._momentum_ptrs = [optimizer.state[p]['momentum_buffer'].data_ptr() for p in self.params]
+    return self._momentum
+
+  def views(self, vectors):
+    # {name: view} of vectors with the layout of the buffers
+    views = {}
+    for group, vector in zip(self.groups, vectors):
+      offset = 0
+      for k, p in group:
+        views[k] = vector[offset:offset+p.numel()].view_as(p)
+        offset += p.numel()
+    return views
+
+
+def flat_parameters(model):
+  """ FlatParameters of the trainable parameters of model, shared by the
+  Architect and the Analyzer of the model and rebuilt when they change. A
+  frozen stem has no gradients and is not unrolled.
+  """
+  named = [(k, v) for k, v in model.named_parameters() if v.requires_grad]
+  flat = getattr(model, '_flat_parameters', None)
+  if flat is None or not flat.matches([v for _, v in named]):
+    flat = model._flat_parameters = FlatParameters(named)
+  return flat
+
+
+def _norm(vectors):
+  return torch.stack([v.norm() for v in vectors]).norm()
+
+
+def weight_gradients(model, input, target, create_graph=False):
+  """ dL_train/dw of the trainable weights, in the order of
+  flat_parameters(model). With create_graph the gradients keep their graph,
+  so exact_hvp can differentiate them again without another forward pass.
+  """
+  loss = model._loss(input, target)
+  return _grads_or_zeros(loss, flat_parameters(model).params, create_graph=create_graph)
+
+
+def unrolled_parameters(model, grads, eta, network_optimizer, momentum, weight_decay):
+  """ Weights after one SGD step on the training batch,
+  w' = w - eta * (momentum * buf + dL_train/dw + weight_decay * w), with grads
+  from weight_gradients.
+
+  Returns:
+    dict of leaf tensors keyed by parameter name, detached from the alphas, in
+    the order of flat_parameters(model). They are views into vectors with its
+    layout, but each is its own leaf so its gradient is not scattered into a
+    full vector.
+  """
+  flat = flat_parameters(model)
+  moments = flat.momentum(network_optimizer)
+  theta = [w - eta*(momentum*m + weight_decay*w) for w, m in zip(flat.data, moments)]
+  views = flat.views(theta)
+  # the gradients are separate tensors, they are added to their views instead of being concatenated
+  torch._foreach_add_(list(views.values()), [g.detach() for g in grads], alpha=-eta)
+  return {k: v.requires_grad_() for k, v in views.items()}
+
+
+def finite_difference_hvp(model, vector, input, target, r=1e-2):
+  """ d/dalpha (dL_train/dw . vector) as the central difference of
+  dL_train/dalpha at w + R*vector and w - R*vector, R = r/|vector|. Two more
+  forward and backward passes, the weights are perturbed in place and the
+  batch norm statistics are updated twice.
+  """
+  R = r / _norm(vector)
+  weights = flat_parameters(model).data
+  for w, v in zip(weights, vector):
+    w.add_(R*v)
+  loss = model._loss(input, target)
+  grads_p = _grads_or_zeros(loss, model.arch_parameters())
+
+  for w, v in zip(weights, vector):
+    w.sub_(2*R*v)
+  loss = model._loss(input, target)
+  grads_n = _grads_or_zeros(loss, model.arch_parameters())
+
+  for w, v in zip(weights, vector):
+    w.add_(R*v)
+
+  return [(x-y).div_(2*R) for x, y in zip(grads_p, grads_n)]
+
+
+def exact_hvp(model, vector, input=None, target=None, grads=None):
+  """ d/dalpha (dL_train/dw . vector) by differentiating the gradient twice
+  (Pearlmutter's trick). grads are dL_train/dw from
+  weight_gradients(create_graph=True), e.g. those of the unrolled step.
+  Without them they are computed from input and target.
+  """
+  if grads is None:
+    grads = weight_gradients(model, input, target, create_graph=True)
+  dot = sum(torch.dot(g, v) for g, v in zip(flat_parameters(model).flatten(grads), vector))
+  return _grads_or_zeros(dot, model.arch_parameters())
+
+
+def functional_loss(model, params, input, target):
+  """ Loss of model with its parameters replaced by params, without building a
+  new Network. The buffers are copies, so the batch norm statistics of model
+  are not updated.
+  """
+  buffers = {k: b.clone() for k, b in model.named_buffers()}
+  logits = functional_call(model, (params, buffers), (input,))
+  return model._criterion(logits, target.long())
 
 
 class Architect(object):
@@ -14,20 +175,10 @@ class Architect(object):
     self.network_momentum = args.momentum
     self.network_weight_decay = args.weight_decay
     self.model = model
+    self.hvp = args.hvp
     self.optimizer = torch.optim.Adam(self.model.arch_parameters(),
         lr=args.arch_learning_rate, betas=(0.5, 0.999), weight_decay=args.arch_weight_decay)
 
-  def _compute_unrolled_model(self, input, target, eta, network_optimizer):
-    loss = self.model._loss(input, target)
-    theta = _concat(self.model.parameters()).data
-    try:
-      moment = _concat(network_optimizer.state[v]['momentum_buffer'] for v in self.model.parameters()).mul_(self.network_momentum)
-    except:
-      moment = torch.zeros_like(theta)
-    dtheta = _concat(torch.autograd.grad(loss, self.model.parameters())).data + self.network_weight_decay*theta
-    unrolled_model = self._construct_model_from_theta(theta.sub(eta, moment+dtheta))
-    return unrolled_model
-
   def step(self, input_train, target_train, input_valid, target_valid, eta, network_optimizer, unrolled):
     self.optimizer.zero_grad()
     if unrolled:
@@ -41,54 +192,31 @@ class Architect(object):
     loss.backward()
 
   def _backward_step_unrolled(self, input_train, target_train, input_valid, target_valid, eta, network_optimizer):
-    unrolled_model = self._compute_unrolled_model(input_train, target_train, eta, network_optimizer)
-    unrolled_loss = unrolled_model._loss(input_valid, target_valid)
-
-    unrolled_loss.backward()
-    dalpha = [v.grad for v in unrolled_model.arch_parameters()]
-    vector = [v.grad.data for v in unrolled_model.parameters()]
-    implicit_grads = self._hessian_vector_product(vector, input_train, target_train)
+    # the reuse mode keeps the graph of the training gradients for the Hessian-vector product
+    reuse = self.hvp == 'reuse'
+    train_grads = weight_gradients(self.model, input_train, target_train, create_graph=reuse)
+    params = unrolled_parameters(self.model, train_grads, eta, network_optimizer,
+                                 self.network_momentum, self.network_weight_decay)
+    unrolled_loss = functional_loss(self.model, params, input_valid, target_valid)
+
+    arch_parameters = self.model.arch_parameters()
+    grads = _grads_or_zeros(unrolled_loss, arch_parameters + list(params.values()))
+    dalpha = grads[:len(arch_parameters)]
+    vector = flat_parameters(self.model).flatten(grads[len(arch_parameters):])
+    implicit_grads = self._hessian_vector_product(vector, input_train, target_train,
+                                                  train_grads if reuse else None)
 
     for g, ig in zip(dalpha, implicit_grads):
-      g.data.sub_(eta, ig.data)
+      g.sub_(eta*ig)
 
-    for v, g in zip(self.model.arch_parameters(), dalpha):
+    for v, g in zip(arch_parameters, dalpha):
       if v.grad is None:
-        v.grad = Variable(g.data)
+        v.grad = Variable(g)
       else:
-        v.grad.data.copy_(g.data)
-
-  def _construct_model_from_theta(self, theta):
-    model_new = self.model.new()
-    model_dict = self.model.state_dict()
-
-    params, offset = {}, 0
-    for k, v in self.model.named_parameters():
-      v_length = np.prod(v.size())
-      params[k] = theta[offset: offset+v_length].view(v.size())
-      offset += v_length
-
-    assert offset == len(theta)
-    model_dict.update(params)
-    model_new.load_state_dict(model_dict)
-    if not model_new.args.disable_cuda:
-      model_new.cuda = model_new.cuda()
-    return model_new
-
-  def _hessian_vector_product(self, vector, input, target, r=1e-2):
-    R = r / _concat(vector).norm()
-    for p, v in zip(self.model.parameters(), vector):
-      p.data.add_(R, v)
-    loss = self.model._loss(input, target)
-    grads_p = torch.autograd.grad(loss, self.model.arch_parameters())
-
-    for p, v in zip(self.model.parameters(), vector):
-      p.data.sub_(2*R, v)
-    loss = self.model._loss(input, target)
-    grads_n = torch.autograd.grad(loss, self.model.arch_parameters())
-
-    for p, v in zip(self.model.parameters(), vector):
-      p.data.add_(R, v)
-
-    return [(x-y).div_(2*R) for x, y in zip(grads_p, grads_n)]
+        v.grad.data.copy_(g)
 
+  def _hessian_vector_product(self, vector, input, target, grads=None, r=1e-2):
+    # vector has the layout of flat_parameters(self.model)
+    if self.hvp == 'finite':
+      return finite_difference_hvp(self.model, vector, input, target, r)
+    return exact_hvp(self.model, vector, input, target, grads)
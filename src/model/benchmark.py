@@ -0,0 +1,381 @@
+import os
+import sys
+import json
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import time
+import logging
+import numpy as np
+import torch
+import torch.nn as nn
+
+import utils
+from space import spaces_dict
+from model_search import Network
+from net import DerivedNetwork
+import export
+from freeze import freeze
+from stream import StreamingRecognizer, keypoints_to_frame
+from incremental import IncrementalNetwork
+import server
+from architect import Architect, flat_parameters, weight_gradients, unrolled_parameters, functional_loss, exact_hvp
+
+sys.path.append("..")
+import genotypes
+from dataset.graph import Graph
+from args import helper, args
+
+log_format = '%(asctime)s %(message)s'
+logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                    format=log_format, datefmt='%m/%d %I:%M:%S %p')
+
+
+def time_it(fn, repeats):
+    # median wall time of fn after one warm-up call
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def bench_parallel_ops(model, input, target):
+    """ Step time of the search network for every combination of op threads
+    (--parallel_ops) and intra-op threads (torch.set_num_threads).
+    """
+    def forward():
+        with torch.no_grad():
+            model(input)
+
+    def step():
+        model.zero_grad()
+        model._loss(input, target).backward()
+
+    threads = [int(t) for t in args.bench_threads.split(',')]
+    base = None
+    logging.info('op_threads intra_threads forward(s) forward+backward(s) speedup')
+    for op_threads in threads:
+        for intra_threads in threads:
+            torch.set_num_threads(intra_threads)
+            model.set_op_threads(op_threads)
+            t_forward = time_it(forward, args.bench_repeats)
+            t_step = time_it(step, args.bench_repeats)
+            base = base or t_step
+            logging.info('%10d %13d %10.4f %19.4f %7.2f', op_threads, intra_threads, t_forward, t_step, base / t_step)
+    model.set_op_threads(args.parallel_ops)
+
+
+def bench_derived(model, input, target, criterion):
+    """ Parameter count and latency of the derived network of --arch against
+    the supernet it was searched in, with the same nodes and concatenation.
+    """
+    genotype = getattr(genotypes, args.arch)
+    derived = DerivedNetwork(args.init_channels, model.AB, args.n_classes, args.layers, genotype,
+                             fuse_stem=args.fuse_stem)
+    supernet = Network(args.init_channels, model.AB, args.n_classes, layers=args.layers, criterion=criterion,
+                       data_shape=model.data_shape, primitives=model.PRIMITIVES, steps=len(genotype.normal) // 2,
+                       multiplier=len(genotype.normal_concat), args=args)
+    if not args.disable_cuda:
+        derived = derived.cuda()
+        supernet = supernet.cuda()
+
+    logging.info('model params(MB) eval_forward(s) train_step(s)')
+    for name, net in [('supernet', supernet), ('derived', derived)]:
+        def forward():
+            with torch.no_grad():
+                net(input)
+
+        def step():
+            net.zero_grad()
+            criterion(net(input), target.long()).backward()
+
+        net.eval()
+        t_forward = time_it(forward, args.bench_repeats)
+        net.train()
+        t_step = time_it(step, args.bench_repeats)
+        logging.info('%s %f %f %f', name, utils.count_parameters_in_MB(net), t_forward, t_step)
+
+
+def bench_hvp(model, input, target, input_valid, target_valid):
+    """ Time and peak memory of the unrolled architecture step for every
+    Hessian-vector product mode of --bench_hvp_modes, and the relative error of
+    the implicit gradient against the exact one. On CPU the peak is the
+    resident size of the whole process, so run one mode per process to
+    compare it.
+    """
+    optimizer = torch.optim.SGD(model.parameters(), args.learning_rate, momentum=args.momentum,
+                                weight_decay=args.weight_decay)
+    optimizer.zero_grad()
+    model._loss(input, target).backward()
+    optimizer.step()
+    architect = Architect(model, args)
+    # the vector of the unrolled step, dL_valid/dw'
+    params = unrolled_parameters(model, weight_gradients(model, input, target), args.learning_rate, optimizer,
+                                 args.momentum, args.weight_decay)
+    unrolled_loss = functional_loss(model, params, input_valid, target_valid)
+    grads = torch.autograd.grad(unrolled_loss, list(params.values()), allow_unused=True)
+    vector = flat_parameters(model).flatten(grads)
+    exact = torch.cat([h.reshape(-1) for h in exact_hvp(model, vector, input, target)])
+
+    logging.info('peak memory: %s', utils.peak_memory_scope(args.disable_cuda))
+    logging.info('mode   unrolled_step(s) peak_memory(MB) hvp_error')
+    for mode in args.bench_hvp_modes.split(','):
+        architect.hvp = mode
+        if not args.disable_cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+        def step():
+            architect.optimizer.zero_grad()
+            architect._backward_step_unrolled(input, target, input_valid, target_valid, args.learning_rate,
+                                              optimizer)
+
+        t_step = time_it(step, args.bench_repeats)
+        grads = weight_gradients(model, input, target, create_graph=True) if mode == 'reuse' else None
+        hvp = torch.cat([h.reshape(-1) for h in architect._hessian_vector_product(vector, input, target, grads)])
+        error = ((hvp - exact).norm() / exact.norm()).item()
+        logging.info('%-6s %16.4f %15.0f %9.2e', mode, t_step, utils.peak_memory_in_MB(args.disable_cuda), error)
+
+
+def bench_export(A, data_shape):
+    """ Latency and throughput of the derived network of --arch in eager mode,
+    scripted (export.script) and in onnxruntime, on CPU for every batch size
+    of --bench_batch_sizes.
+    """
+    genotype = getattr(genotypes, args.arch)
+    derived = DerivedNetwork(args.init_channels, A, args.n_classes, args.layers, genotype,
+                             fuse_stem=args.fuse_stem)
+    derived.eval()
+    runtimes = [('eager', derived), ('scripted', export.script(derived))]
+    try:
+        import onnxruntime
+        path = os.path.join(args.save, 'derived_{}.onnx'.format(args.arch))
+        export.export_onnx(derived, export.example_input(1, data_shape), path)
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        runtimes.append(('onnxruntime', lambda x: torch.from_numpy(session.run(None, {'input': x.numpy()})[0])))
+    except ImportError:
+        logging.info('onnxruntime is not installed, skipping it')
+
+    logging.info('runtime batch_size latency(ms) samples/s max_abs_diff')
+    for batch_size in [int(b) for b in args.bench_batch_sizes.split(',')]:
+        input = torch.randn([batch_size] + list(data_shape))
+        with torch.no_grad():
+            reference = derived(input)
+            for name, run in runtimes:
+                t = time_it(lambda: run(input), args.bench_repeats)
+                diff = (run(input) - reference).abs().max().item()
+                logging.info('%11s %10d %11.2f %9.1f %12.2e', name, batch_size, t * 1000, batch_size / t, diff)
+
+
+def synthetic_keypoints(rng, num_joints):
+    # x, y and score of every joint, as in the DeepLabCut json files
+    points = np.stack([rng.uniform(0, 640, num_joints), rng.uniform(10, 480, num_joints),
+                       rng.uniform(0.5, 1, num_joints)], axis=1)
+    return points.reshape(-1).tolist()
+
+
+def bench_stream(A, data_shape):
+    """ Per-window latency and throughput of StreamingRecognizer with
+    --stream_cameras synthetic pose streams, one window at a time and with the
+    windows of all cameras batched together.
+    """
+    genotype = getattr(genotypes, args.arch)
+    derived = DerivedNetwork(args.init_channels, A, args.n_classes, args.layers, genotype,
+                             fuse_stem=args.fuse_stem)
+    model = freeze(derived.eval())
+    connect_joint = Graph(args.dataset).connect_joint
+    num_joints = data_shape[3]
+    rng = np.random.RandomState(args.seed)
+
+    logging.info('max_batch windows p50(ms) p95(ms) max(ms) windows/s frames/s')
+    for max_batch in [1, args.stream_cameras]:
+        recognizer = StreamingRecognizer(model, connect_joint, window=data_shape[2], stride=args.stream_stride,
+                                         max_batch=max_batch, num_joints=num_joints)
+        latencies = []
+        start = time.time()
+        for t in range(args.stream_frames):
+            # the cameras start at different frames, so their windows are not all due at once
+            frames = [(k, synthetic_keypoints(rng, num_joints)) for k in range(args.stream_cameras)
+                      if t >= k * args.stream_stride // args.stream_cameras]
+            latencies += [p.latency for p in recognizer.step(frames)]
+        elapsed = time.time() - start
+        latencies = np.array(latencies) * 1000
+        logging.info('%9d %7d %7.1f %7.1f %7.1f %9.1f %8.1f', max_batch, len(latencies), np.percentile(latencies, 50),
+                     np.percentile(latencies, 95), latencies.max(), len(latencies) / elapsed,
+                     args.stream_frames * args.stream_cameras / elapsed)
+
+
+def bench_incremental(A, data_shape):
+    """ Time per frame of --stream_cameras streams with windowed inference
+    (StreamingRecognizer, all cameras batched) and with IncrementalNetwork, and
+    how often the two agree on the label of a window.
+    """
+    genotype = getattr(genotypes, args.arch)
+    derived = DerivedNetwork(args.init_channels, A, args.n_classes, args.layers, genotype,
+                             fuse_stem=args.fuse_stem)
+    model = freeze(derived.eval())
+    connect_joint = Graph(args.dataset).connect_joint
+    window, num_joints = data_shape[2], data_shape[3]
+    rng = np.random.RandomState(args.seed)
+    keypoints = [[synthetic_keypoints(rng, num_joints) for _ in range(args.stream_cameras)]
+                 for _ in range(args.stream_frames)]
+
+    windowed = StreamingRecognizer(model, connect_joint, window=window, stride=args.stream_stride,
+                                   max_batch=args.stream_cameras, num_joints=num_joints)
+    labels = {}
+    start = time.time()
+    for frames in keypoints:
+        for p in windowed.step(enumerate(frames)):
+            labels[(p.stream, p.frame)] = p.label
+    t_windowed = time.time() - start
+
+    incremental = IncrementalNetwork(model, connect_joint, window=window, stride=args.stream_stride)
+    agree, total = 0, 0
+    start = time.time()
+    with torch.no_grad():
+        # one update per --stream_stride frames
+        for t in range(0, args.stream_frames, args.stream_stride):
+            x = np.stack([np.stack([keypoints_to_frame(k, num_joints) for k in frames], axis=1)
+                          for frames in zip(*keypoints[t:t + args.stream_stride])])
+            for frame, logits in incremental(torch.from_numpy(x)):
+                for k, label in enumerate(logits.argmax(dim=1).tolist()):
+                    agree += labels[(k, frame)] == utils.ACTION_NAMES[label]
+                    total += 1
+    t_incremental = time.time() - start
+
+    logging.info('mode windows ms/frame')
+    logging.info('windowed %d %.2f', len(labels), t_windowed / args.stream_frames * 1000)
+    logging.info('incremental %d %.2f', total, t_incremental / args.stream_frames * 1000)
+    logging.info('speedup %.2f, incremental delay %d frames, label agreement %.3f',
+                 t_windowed / t_incremental, incremental.delay, agree / max(total, 1))
+
+
+def bench_server(A, data_shape):
+    """ Throughput and latency of server.py for --bench_requests requests of
+    --bench_clients concurrent clients, without batching and with a dynamic
+    batch of --max_batch.
+    """
+    genotype = getattr(genotypes, args.arch)
+    derived = DerivedNetwork(args.init_channels, A, args.n_classes, args.layers, genotype,
+                             fuse_stem=args.fuse_stem)
+    model = freeze(derived.eval())
+    connect_joint = Graph(args.dataset).connect_joint
+    I, C, T, V, M = data_shape
+    body = json.dumps({'data': np.random.RandomState(args.seed).randn(C, T, V).tolist()}).encode('utf-8')
+
+    logging.info('max_batch requests/s mean_batch p50(ms) p95(ms) p99(ms)')
+    for max_batch in [1, args.max_batch]:
+        httpd, batcher = server.serve(model, connect_joint, data_shape, args.server_host, 0, max_batch,
+                                      args.max_delay_ms / 1000, args.server_workers)
+        url = 'http://{}:{}'.format(args.server_host, httpd.server_address[1])
+
+        def request(_):
+            return urllib.request.urlopen(urllib.request.Request(url + '/predict', data=body)).read()
+
+        try:
+            with ThreadPoolExecutor(max_workers=args.bench_clients) as clients:
+                list(clients.map(request, range(args.bench_clients)))
+                start = time.time()
+                list(clients.map(request, range(args.bench_requests)))
+                elapsed = time.time() - start
+            stats = json.loads(urllib.request.urlopen(url + '/stats').read())
+        finally:
+            httpd.shutdown()
+            batcher.close()
+        logging.info('%9d %10.1f %10.1f %7.1f %7.1f %7.1f', max_batch, args.bench_requests / elapsed,
+                     stats['mean_batch_size'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'])
+
+
+def _post(url, body):
+    # status and JSON reply of a POST, also for error codes
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, data=body))
+        return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+class _FailingModel(nn.Module):
+    def forward(self, input):
+        raise RuntimeError('model failure')
+
+
+def bench_server_errors(A, data_shape):
+    """ Status of server.py for malformed requests, a timeout and a model error.
+    Each of them must get its JSON error reply instead of a dropped connection.
+    """
+    genotype = getattr(genotypes, args.arch)
+    model = freeze(DerivedNetwork(args.init_channels, A, args.n_classes, args.layers, genotype,
+                                  fuse_stem=args.fuse_stem).eval())
+    connect_joint = Graph(args.dataset).connect_joint
+    I, C, T, V, M = data_shape
+    body = json.dumps({'data': np.random.RandomState(args.seed).randn(C, T, V).tolist()}).encode('utf-8')
+    cases = [(model, 30.0, b'not json', 400),
+             (model, 30.0, json.dumps([1, 2]).encode('utf-8'), 400),
+             (model, 30.0, json.dumps({'data': np.zeros((C, T)).tolist()}).encode('utf-8'), 400),
+             (model, 30.0, json.dumps({'data': [['a']]}).encode('utf-8'), 400),
+             (model, 30.0, json.dumps({'keypoints': 5}).encode('utf-8'), 400),
+             (model, 30.0, json.dumps({'keypoints': [[1.0, 2.0]]}).encode('utf-8'), 400),
+             (model, 30.0, json.dumps({'other': 1}).encode('utf-8'), 400),
+             (model, 1e-3, body, 504),
+             (_FailingModel(), 30.0, body, 500)]
+
+    logging.info('expected status error')
+    failed = 0
+    for case_model, timeout, case_body, expected in cases:
+        httpd, batcher = server.serve(case_model, connect_joint, data_shape, args.server_host, 0, 1,
+                                      args.max_delay_ms / 1000, 1, timeout)
+        try:
+            url = 'http://{}:{}/predict'.format(args.server_host, httpd.server_address[1])
+            code, reply = _post(url, case_body)
+        finally:
+            httpd.shutdown()
+            batcher.close()
+        ok = code == expected and 'error' in reply
+        failed += not ok
+        logging.info('%8d %6d %s%s', expected, code, reply.get('error'), '' if ok else '  FAILED')
+    if failed:
+        raise RuntimeError('{} of {} server error cases failed'.format(failed, len(cases)))
+
+
+def main(primitives):
+    torch.manual_seed(args.seed)
+    criterion = nn.CrossEntropyLoss()
+    train_queue, valid_queue, data_shape, num_class, A, parts = helper.get_train_val_loaders()
+    A = torch.from_numpy(A)
+    model = Network(args.init_channels, A, args.n_classes, layers=args.layers, criterion=criterion,
+                    data_shape=data_shape, primitives=primitives, steps=args.nodes, args=args)
+    input, target, _ = next(iter(train_queue))
+    input_valid, target_valid, _ = next(iter(valid_queue))
+    if not args.disable_cuda:
+        model = model.cuda()
+        criterion = criterion.cuda()
+        input = input.cuda()
+        target = target.cuda()
+        input_valid = input_valid.cuda()
+        target_valid = target_valid.cuda()
+    model.train()
+    logging.info('param size = %fMB, batch size = %d', utils.count_parameters_in_MB(model), input.size(0))
+
+    if args.bench == 'parallel_ops':
+        bench_parallel_ops(model, input, target)
+    elif args.bench == 'derived':
+        bench_derived(model, input, target, criterion)
+    elif args.bench == 'hvp':
+        bench_hvp(model, input, target, input_valid, target_valid)
+    elif args.bench == 'export':
+        bench_export(A, data_shape)
+    elif args.bench == 'stream':
+        bench_stream(A, data_shape)
+    elif args.bench == 'incremental':
+        bench_incremental(A, data_shape)
+    elif args.bench == 'server':
+        bench_server(A, data_shape)
+    elif args.bench == 'server_errors':
+        bench_server_errors(A, data_shape)
+
+
+if __name__ == '__main__':
+    main(spaces_dict[args.space])
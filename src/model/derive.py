@@ -0,0 +1,57 @@
+import os
+import sys
+import logging
+import torch
+import torch.nn as nn
+
+import utils
+from space import spaces_dict
+from model_search import Network
+from net import DerivedNetwork, inherit_supernet_weights
+
+sys.path.append("..")
+from args import helper, args
+
+log_format = '%(asctime)s %(message)s'
+logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                    format=log_format, datefmt='%m/%d %I:%M:%S %p')
+
+
+def main(primitives):
+    """ Derive the genotype of the search checkpoint of --checkpoint_epoch and
+    export a DerivedNetwork that inherits the weights of the selected ops.
+    """
+    filename = os.path.join(args.save, 'checkpoint_{}_{}.pth.tar'.format(args.task_id, args.checkpoint_epoch))
+    checkpoint = torch.load(filename, map_location='cpu')
+
+    train_queue, valid_queue, data_shape, num_class, A, parts = helper.get_train_val_loaders()
+    A = torch.from_numpy(A)
+    model = Network(args.init_channels, A, args.n_classes, layers=args.layers, criterion=nn.CrossEntropyLoss(),
+                    data_shape=data_shape, primitives=primitives, steps=args.nodes, args=args)
+    if checkpoint.get('primitives') is not None and checkpoint['primitives'] != model.PRIMITIVES:
+        model.prune_to(checkpoint['primitives'])
+    model.load_state_dict(checkpoint['state_dict'])
+    model.alphas_normal.data = checkpoint['alphas_normal']
+    if checkpoint.get('betas_normal') is not None:
+        model.betas_normal.data = checkpoint['betas_normal']
+    genotype = model.genotype()
+    logging.info('genotype = %s', genotype)
+
+    derived = DerivedNetwork(args.init_channels, A, args.n_classes, args.layers, genotype,
+                             fuse_stem=args.fuse_stem)
+    missing = inherit_supernet_weights(derived, model.state_dict(), model.PRIMITIVES['primitives_normal'])
+    logging.info('search network %fMB, derived network %fMB, not inherited: %s',
+                 utils.count_parameters_in_MB(model), utils.count_parameters_in_MB(derived), missing)
+
+    state = {'state_dict': derived.state_dict(),
+             'normal': genotype.normal,
+             'normal_concat': list(genotype.normal_concat),
+             'epoch': args.checkpoint_epoch,
+             }
+    filename = os.path.join(args.save, 'derived_{}_{}.pth.tar'.format(args.task_id, args.checkpoint_epoch))
+    torch.save(state, filename)
+    logging.info('saved %s', filename)
+
+
+if __name__ == '__main__':
+    main(spaces_dict[args.space])
@@ -0,0 +1,69 @@
+import os
+import sys
+import logging
+import torch
+
+from net import DerivedNetwork
+from freeze import freeze
+
+sys.path.append("..")
+import genotypes
+from args import helper, args
+
+log_format = '%(asctime)s %(message)s'
+logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                    format=log_format, datefmt='%m/%d %I:%M:%S %p')
+
+
+def example_input(batch_size, data_shape, device='cpu'):
+    # (N, I, C, T, V, M) with the data_shape of dataset/init.py
+    return torch.zeros([batch_size] + list(data_shape), device=device)
+
+
+def script(model):
+    """ TorchScript module of a trained DerivedNetwork, from its frozen copy
+    (freeze.FrozenNetwork).
+    """
+    return torch.jit.script(freeze(model))
+
+
+def trace(model, input):
+    return torch.jit.trace(freeze(model), input)
+
+
+def export_onnx(model, input, path, opset_version=17):
+    """ Write the frozen copy of a DerivedNetwork to an ONNX file. All dims but
+    the batch size are fixed to the ones of input.
+    """
+    with torch.no_grad():
+        torch.onnx.export(freeze(model), (input,), path, input_names=['input'], output_names=['logits'],
+                          dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}},
+                          opset_version=opset_version, dynamo=False)
+
+
+def load_derived(filename, A):
+    # DerivedNetwork of a file written by derive.py, in eval mode
+    state = torch.load(filename, map_location='cpu')
+    genotype = genotypes.Genotype(normal=[tuple(op) for op in state['normal']], normal_concat=state['normal_concat'])
+    model = DerivedNetwork(args.init_channels, A, args.n_classes, args.layers, genotype,
+                           fuse_stem=args.fuse_stem)
+    model.load_state_dict(state['state_dict'])
+    return model.eval()
+
+
+def main():
+    """ Export the network written by derive.py for --checkpoint_epoch to
+    TorchScript (.pt) and ONNX (.onnx).
+    """
+    filename = os.path.join(args.save, 'derived_{}_{}'.format(args.task_id, args.checkpoint_epoch))
+    _, _, data_shape, _, A, _ = helper.get_train_val_loaders()
+    model = load_derived(filename + '.pth.tar', torch.from_numpy(A))
+
+    input = example_input(1, data_shape)
+    script(model).save(filename + '.pt')
+    export_onnx(model, input, filename + '.onnx')
+    logging.info('saved %s.pt and %s.onnx', filename, filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+import copy
+from typing import List, Optional
+
+import torch
+from torch import nn
+
+from operations import (Identity, Zero, Spatial_Bottleneck_Block, Temporal_Bottleneck_Block,
+                        Part_Att, Part_Share_Att, Part_Conv_Att)
+
+
+def fold_bn(conv, bn):
+    """ Conv2d with the eval-mode BatchNorm2d that follows it folded into its
+    weights and bias.
+    """
+    scale, shift = bn_scale_shift(bn)
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+                      conv.padding, conv.dilation, conv.groups, bias=True)
+    bias = conv.bias.detach() if conv.bias is not None else torch.zeros_like(scale)
+    fused.weight.data = conv.weight.detach() * scale.view(-1, 1, 1, 1)
+    fused.bias.data = bias * scale + shift
+    return fused
+
+
+def fold_bn_input(bn, conv):
+    """ Fold the eval-mode BatchNorm2d in front of a (grouped) 1x1 Conv2d into
+    the convolution.
+    """
+    assert conv.kernel_size == (1, 1) and conv.padding == (0, 0)
+    scale, shift = bn_scale_shift(bn)
+    g = conv.groups
+    w = conv.weight.detach().view(g, conv.out_channels // g, -1)
+    bias = conv.bias.detach() if conv.bias is not None else w.new_zeros(conv.out_channels)
+    conv.bias = nn.Parameter(bias + (w * shift.view(g, 1, -1)).sum(dim=-1).view(-1))
+    conv.weight.data = (w * scale.view(g, 1, -1)).view_as(conv.weight)
+
+
+def bn_scale_shift(bn):
+    # per channel y = scale * x + shift of a BatchNorm2d in eval mode
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        scale = scale * bn.weight.detach()
+        shift = shift * bn.weight.detach() + bn.bias.detach()
+    return scale, shift
+
+
+def fold_sequential(module):
+    # folds every Conv2d -> BatchNorm2d pair of the nn.Sequential containers of module, in place.
+    # part_pool is indexed by the part attentions, FrozenPartAtt folds it
+    for name, child in module.named_children():
+        if isinstance(child, nn.Sequential) and name != 'part_pool':
+            layers = list(child)
+            folded = []
+            i = 0
+            while i < len(layers):
+                if (i + 1 < len(layers) and isinstance(layers[i], nn.Conv2d)
+                        and isinstance(layers[i + 1], nn.BatchNorm2d)):
+                    folded.append(fold_bn(layers[i], layers[i + 1]))
+                    i += 2
+                else:
+                    folded.append(layers[i])
+                    i += 1
+            setattr(module, name, nn.Sequential(*folded))
+        fold_sequential(getattr(module, name))
+    return module
+
+
+def residual_mode(residual):
+    """ 0 for the zero residual lambda, 1 for the identity lambda, 2 for a
+    conv residual module.
+    """
+    if isinstance(residual, nn.Module):
+        return 2
+    marker = object()
+    return 1 if residual(marker) is marker else 0
+
+
+def frozen_residual(residual):
+    if residual_mode(residual) == 2:
+        return fold_bn(residual[0], residual[1])
+    return nn.Identity()
+
+
+def graph_weights(A, edge):
+    # the ops multiply A and edge in double precision and the graph conv casts to float32
+    return (A.detach().double() * edge.detach().double()).float()
+
+
+class FrozenGraphConv(nn.Module):
+    """ SpatialGraphConv followed by its BatchNorm2d, with a constant adjacency
+    (A * edge) and the BN scale folded into the 1x1 conv. The BN shift is added
+    after the graph aggregation.
+    """
+    def __init__(self, conv, bn, A):
+        super(FrozenGraphConv, self).__init__()
+        self.s_kernel_size = conv.s_kernel_size
+        self.groups = conv.groups
+        scale, shift = bn_scale_shift(bn)
+
+        gcn = conv.gcn
+        K, G = self.s_kernel_size, self.groups
+        C = gcn.out_channels // (K * G)
+        # output channel (g, k, c) of the 1x1 conv feeds output channel (g, c) of the graph conv
+        s = scale.view(G, 1, C).expand(G, K, C).reshape(-1)
+        self.gcn = nn.Conv2d(gcn.in_channels, gcn.out_channels, 1, groups=gcn.groups, bias=True)
+        self.gcn.weight.data = gcn.weight.detach() * s.view(-1, 1, 1, 1)
+        self.gcn.bias.data = gcn.bias.detach() * s
+        if G > 1:
+            self.register_buffer('A', A[:, :K].contiguous())
+        else:
+            self.register_buffer('A', A[:K].contiguous())
+        self.register_buffer('shift', shift.view(1, -1, 1, 1))
+
+    def forward(self, x):
+        x = self.gcn(x)
+        n, gkc, t, v = x.size()
+        if self.groups > 1:
+            x = x.view(n, self.groups, self.s_kernel_size, gkc // self.groups // self.s_kernel_size, t, v)
+            x = torch.einsum('ngkctv,gkvw->ngctw', x, self.A).reshape(n, -1, t, v)
+        else:
+            x = x.view(n, self.s_kernel_size, gkc // self.s_kernel_size, t, v)
+            x = torch.einsum('nkctv,kvw->nctw', x, self.A)
+        return x + self.shift
+
+
+class FrozenSpatialBlock(nn.Module):
+    # Spatial_Basic_Block or Spatial_Bottleneck_Block
+    def __init__(self, block, A):
+        super(FrozenSpatialBlock, self).__init__()
+        if isinstance(block, Spatial_Bottleneck_Block):
+            self.down = nn.Sequential(fold_bn(block.conv_down, block.bn_down), nn.ReLU(inplace=True))
+            self.up = nn.Sequential(nn.ReLU(inplace=True), fold_bn(block.conv_up, block.bn_up))
+        else:
+            self.down = nn.Identity()
+            self.up = nn.Identity()
+        self.gcn = FrozenGraphConv(block.conv, block.bn, A)
+        self.res_mode = residual_mode(block.residual)
+        self.residual = frozen_residual(block.residual)
+
+    def forward(self, x):
+        y = self.up(self.gcn(self.down(x)))
+        if self.res_mode == 2:
+            y = y + self.residual(x)
+        elif self.res_mode == 1:
+            y = y + x
+        return torch.relu(y)
+
+
+class FrozenTemporalBlock(nn.Module):
+    # Temporal_Basic_Block or Temporal_Bottleneck_Block
+    def __init__(self, block):
+        super(FrozenTemporalBlock, self).__init__()
+        if isinstance(block, Temporal_Bottleneck_Block):
+            self.body = nn.Sequential(
+                fold_bn(block.conv_down, block.bn_down), nn.ReLU(inplace=True),
+                fold_bn(block.conv, block.bn), nn.ReLU(inplace=True),
+                fold_bn(block.conv_up, block.bn_up))
+        else:
+            self.body = fold_bn(block.conv, block.bn)
+        self.res_mode = residual_mode(block.residual)
+        self.residual = frozen_residual(block.residual)
+
+    def forward(self, x, res_module: Optional[torch.Tensor]):
+        y = self.body(x)
+        if self.res_mode == 2:
+            y = y + self.residual(x)
+        elif self.res_mode == 1:
+            y = y + x
+        if res_module is not None:
+            y = y + res_module
+        return torch.relu(y)
+
+
+class FrozenPartAtt(nn.Module):
+    """ Part_Att, Part_Share_Att or Part_Conv_Att with the part layout in
+    buffers. The part_pool BN is folded into its conv, in eval mode the per
+    part pooling of part_pool_features is a masked mean of the ReLU.
+    """
+    def __init__(self, head):
+        super(FrozenPartAtt, self).__init__()
+        head = fold_sequential(copy.deepcopy(head))
+        self.num_parts = len(head.parts)
+        self.fcn = head.fcn
+        self.bn = head.bn
+        self.register_buffer('joints', head.joints.clone())
+        if isinstance(head, (Part_Share_Att, Part_Conv_Att)):
+            self.mode = 1 if isinstance(head, Part_Share_Att) else 2
+            self.part_pool = fold_bn(head.part_pool[0], head.part_pool[1])
+            self.register_buffer('index', head.index.clone())
+            self.register_buffer('mask', head.mask.clone())
+        else:
+            self.mode = 0
+            self.part_pool = nn.Identity()
+            self.register_buffer('index', torch.zeros(1, 1).long())
+            self.register_buffer('mask', torch.zeros(1, 1))
+
+    def forward(self, x):
+        N, C, T, V = x.size()
+        if self.mode == 0:
+            x_att = self.fcn(x)
+        else:
+            P, L = self.index.size()
+            if self.mode == 1:
+                x_part = self.part_pool(x)[:, :, :, self.index.view(-1)]
+                x_part = x_part.view(N, -1, T, P, L).permute(0, 3, 1, 2, 4)
+            else:
+                x_part = x[:, :, :, self.index.view(-1)].view(N, C, T, P, L)
+                x_part = x_part.permute(0, 3, 1, 2, 4).reshape(N, P * C, T, L)
+                x_part = self.part_pool(x_part).view(N, P, -1, T, L)
+            mask = self.mask.to(x.dtype)
+            x_pool = (torch.relu(x_part) * mask[None, :, None, None, :]).sum(dim=(3, 4))
+            x_pool = (x_pool / (mask.sum(dim=1) * T)[None, :, None]).sum(dim=1)
+            x_att = self.fcn(x_pool[:, :, None, None])
+        x_att = torch.softmax(x_att.view(N, C, self.num_parts), dim=-1)
+        x_att = x_att[:, :, self.joints]
+        return torch.relu(self.bn(x * x_att[:, :, None, :]) + x)
+
+
+def freeze_head(att):
+    if isinstance(att, (Part_Att, Part_Share_Att, Part_Conv_Att)):
+        return FrozenPartAtt(att)
+    if isinstance(att, Identity):
+        return nn.Identity()
+    return fold_sequential(copy.deepcopy(att))
+
+
+class FrozenUnit(nn.Module):
+    """ Frozen graph conv unit: ResGCN_Module, Basic_net and the *_bottleneck
+    ops, i.e. every module built as att(tcn(scn(x, A * edge), residual(x))).
+    """
+    def __init__(self, op, A):
+        super(FrozenUnit, self).__init__()
+        self.scn = FrozenSpatialBlock(op.scn, graph_weights(A, op.edge))
+        self.tcn = FrozenTemporalBlock(op.tcn)
+        self.res_mode = residual_mode(op.residual)
+        self.residual = frozen_residual(op.residual)
+        self.att = freeze_head(op.att) if hasattr(op, 'att') else nn.Identity()
+
+    def forward(self, x):
+        res: Optional[torch.Tensor] = None
+        if self.res_mode == 2:
+            res = self.residual(x)
+        elif self.res_mode == 1:
+            res = x
+        return self.att(self.tcn(self.scn(x), res))
+
+
+class FrozenOp(nn.Module):
+    # any other op (SepConv, DilConv, ReLUConvBN, ...) with its Conv2d -> BatchNorm2d pairs folded
+    def __init__(self, op):
+        super(FrozenOp, self).__init__()
+        self.op = fold_sequential(copy.deepcopy(op))
+
+    def forward(self, x):
+        return self.op(x)
+
+
+def freeze_op(op, A):
+    if hasattr(op, 'scn') and hasattr(op, 'tcn') and hasattr(op, 'edge'):
+        return FrozenUnit(op, A)
+    if isinstance(op, Identity):
+        return nn.Identity()
+    return FrozenOp(op)
+
+
+class FrozenBranch(nn.Module):
+    # ResGCN_Input_Branch, its input BatchNorm2d is folded into the first graph conv
+    def __init__(self, branch):
+        super(FrozenBranch, self).__init__()
+        self.layers = nn.ModuleList([FrozenUnit(layer, branch.Ah) for layer in branch.layers])
+        first = self.layers[0]
+        assert first.res_mode == 0 and first.scn.res_mode == 0, 'the input BN feeds only the first graph conv'
+        fold_bn_input(branch.bn, first.scn.gcn.gcn)
+
+    def forward(self, x):
+        N, C, T, V, M = x.size()
+        x = x.float().permute(0, 4, 1, 2, 3).contiguous().view(N * M, C, T, V)
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+
+class FrozenStem(nn.Module):
+    # Input_GCN, fused or with one branch per stream
+    def __init__(self, stem):
+        super(FrozenStem, self).__init__()
+        self.fused = stem.fused
+        if stem.fused:
+            self.branches = nn.ModuleList([FrozenBranch(stem.input_branch)])
+        else:
+            self.branches = nn.ModuleList([FrozenBranch(b) for b in stem.input_branches])
+
+    def forward(self, x):
+        N, I, C, T, V, M = x.size()
+        if self.fused:
+            return self.branches[0](x.reshape(N, I * C, T, V, M))
+        x_cat: List[torch.Tensor] = []
+        for i, branch in enumerate(self.branches):
+            x_cat.append(branch(x[:, i]))
+        return torch.cat(x_cat, dim=1)
+
+
+class FrozenCell(nn.Module):
+    # DerivedCell without its zero ops, identity ops are plain nn.Identity
+    def __init__(self, cell):
+        super(FrozenCell, self).__init__()
+        self.preprocess0 = FrozenUnit(cell.preprocess0, cell.AH)
+        self.preprocess1 = FrozenUnit(cell.preprocess1, cell.AH)
+        self.steps = cell._steps
+        self.concat = list(cell._concat)
+
+        ops, inputs, nodes = [], [], []
+        for k, op in enumerate(cell._ops):
+            if isinstance(op, Zero):
+                continue
+            ops.append(freeze_op(op, cell.AH))
+            inputs.append(cell._indices[k])
+            nodes.append(k // 2)
+        self._ops = nn.ModuleList(ops)
+        self.inputs = inputs
+        self.nodes = nodes
+
+    def forward(self, s0, s1):
+        states = [self.preprocess0(s0), self.preprocess1(s1)]
+        sums: List[Optional[torch.Tensor]] = [None for _ in range(self.steps)]
+        for k, op in enumerate(self._ops):
+            node = self.nodes[k]
+            if node + 2 > len(states):
+                for i in range(len(states) - 2, node):
+                    states.append(self._node(sums[i], states[0]))
+            h = op(states[self.inputs[k]])
+            s = sums[node]
+            sums[node] = h if s is None else s + h
+        for i in range(len(states) - 2, self.steps):
+            states.append(self._node(sums[i], states[0]))
+        return torch.cat([states[i] for i in self.concat], dim=1)
+
+    def _node(self, s: Optional[torch.Tensor], like: torch.Tensor):
+        # a node whose ops were all zero
+        if s is None:
+            return torch.zeros_like(like)
+        return s
+
+
+class FrozenNetwork(nn.Module):
+    """ Inference-only copy of a trained DerivedNetwork.
+
+    Every Conv2d -> BatchNorm2d pair is folded into one convolution, the input
+    BN of the stem into the first graph conv, and the graph conv BNs into their
+    1x1 convs plus a bias. A * edge is precomputed into constant buffers, zero
+    residuals are removed and zero ops dropped. The outputs are the ones of the
+    network in eval mode.
+    """
+    def __init__(self, model):
+        super(FrozenNetwork, self).__init__()
+        self.stem = FrozenStem(model.stem)
+        self.cells = nn.ModuleList([FrozenCell(cell) for cell in model.cells])
+        self.global_pooling = nn.AdaptiveAvgPool2d(1)
+        self.classifier = copy.deepcopy(model.classifier)
+
+    def forward(self, input):
+        # 4-D inputs are cached stem features (N*M, C, T, V)
+        if input.dim() == 4:
+            s1 = input
+        else:
+            s1 = self.stem(input)
+        s0 = s1
+        for cell in self.cells:
+            s0, s1 = s1, cell(s0, s1)
+        out = self.global_pooling(s1)
+        return self.classifier(out.view(out.size(0), -1))
+
+
+def freeze(model):
+    """ FrozenNetwork of a DerivedNetwork, on the device of the model and in
+    eval mode. The model itself is not modified.
+    """
+    device = next(model.parameters()).device
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        frozen = FrozenNetwork(model)
+    model.train(training)
+    return frozen.to(device).eval()
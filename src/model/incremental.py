@@ -0,0 +1,276 @@
+import torch
+from torch import nn
+
+from operations import Channel_Att, Joint_Att
+from freeze import freeze, FrozenNetwork, FrozenPartAtt
+
+
+def temporal_radius(module):
+    """ Frames on each side of an output frame that it depends on. Convolutions
+    and pooling layers are assumed to be chained, so for modules with parallel
+    branches this is an upper bound.
+    """
+    radius = 0
+    for m in module.modules():
+        if isinstance(m, nn.Conv2d):
+            kernel_size, stride, dilation = m.kernel_size[0], m.stride[0], m.dilation[0]
+        elif isinstance(m, (nn.AvgPool2d, nn.MaxPool2d)):
+            kernel_size = m.kernel_size if isinstance(m.kernel_size, int) else m.kernel_size[0]
+            stride = m.stride if isinstance(m.stride, int) else m.stride[0]
+            dilation = 1
+        else:
+            continue
+        if stride != 1:
+            raise ValueError('temporal stride {} of {} is not supported'.format(stride, type(m).__name__))
+        radius += (kernel_size - 1) // 2 * dilation
+    return radius
+
+
+def check_temporally_local(module):
+    # the attentions that pool over all frames of the window would change the past frames
+    for m in module.modules():
+        if isinstance(m, (FrozenPartAtt, Channel_Att, Joint_Att)):
+            raise ValueError('{} pools over the whole window and cannot run incrementally'.format(type(m).__name__))
+
+
+class FrameQueue(object):
+    # consecutive frames [start, end) of a (N, C, T, V) feature stream
+    def __init__(self):
+        self.data = None
+        self.start = 0
+
+    @property
+    def end(self):
+        return self.start if self.data is None else self.start + self.data.size(2)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def push(self, x, start):
+        if x is None:
+            return
+        if self.data is None:
+            self.data, self.start = x, start
+        else:
+            assert start == self.end, 'frames {} pushed after frame {}'.format(start, self.end)
+            self.data = torch.cat([self.data, x], dim=2)
+
+    def pop(self, start, end):
+        # frames [start, end), the frames before end are dropped
+        x = self.data[:, :, start - self.start:end - self.start]
+        self.data = self.data[:, :, end - self.start:]
+        self.start = end
+        return x
+
+
+def join(queues):
+    """ Frames that all queues have, as a list with one (N, C, T, V) tensor per
+    queue and the index of their first frame. Frames that only some of the
+    queues have are dropped from the front, they belong to the warm-up of the
+    layers with a smaller radius.
+    """
+    if any(q.data is None for q in queues):
+        return None, None
+    lo, hi = max(q.start for q in queues), min(q.end for q in queues)
+    if hi <= lo:
+        return None, None
+    return [q.pop(lo, hi) for q in queues], lo
+
+
+class StreamingLayer(nn.Module):
+    """ Temporally local layer that keeps the last 2*radius input frames and
+    computes only the output frames that the new input frames complete. The
+    output lags the input by radius frames.
+    """
+    def __init__(self, op):
+        super(StreamingLayer, self).__init__()
+        self.op = op
+        self.radius = temporal_radius(op)
+        self.reset()
+
+    def reset(self):
+        self.context = FrameQueue()
+
+    def forward(self, x, start):
+        if x is None:
+            return None, None
+        self.context.push(x, start)
+        r, T = self.radius, len(self.context)
+        if T < 2 * r + 1:
+            return None, None
+        y = self.op(self.context.data)[:, :, r:T - r]
+        out_start = self.context.start + r
+        self.context.pop(self.context.start, self.context.end - 2 * r)
+        return y, out_start
+
+
+class IncrementalStem(nn.Module):
+    # FrozenStem with one StreamingLayer per graph conv unit
+    def __init__(self, stem):
+        super(IncrementalStem, self).__init__()
+        self.fused = stem.fused
+        self.branches = nn.ModuleList([nn.ModuleList([StreamingLayer(layer) for layer in branch.layers])
+                                       for branch in stem.branches])
+
+    def reset(self):
+        self.outputs = [FrameQueue() for _ in self.branches]
+
+    def forward(self, x, start):
+        # (N, I, C, T, V) stem inputs of frames [start, start + T)
+        N, I, C, T, V = x.size()
+        inputs = [x.reshape(N, I * C, T, V)] if self.fused else [x[:, i] for i in range(I)]
+        for branch, h, queue in zip(self.branches, inputs, self.outputs):
+            h_start = start
+            for layer in branch:
+                h, h_start = layer(h, h_start)
+            queue.push(h, h_start)
+        joined, lo = join(self.outputs)
+        if joined is None:
+            return None, None
+        return torch.cat(joined, dim=1), lo
+
+
+class IncrementalCell(nn.Module):
+    # FrozenCell with one StreamingLayer per op and queues that align the inputs of the nodes
+    def __init__(self, cell):
+        super(IncrementalCell, self).__init__()
+        self.preprocess0 = StreamingLayer(cell.preprocess0)
+        self.preprocess1 = StreamingLayer(cell.preprocess1)
+        self._ops = nn.ModuleList([StreamingLayer(op) for op in cell._ops])
+        self.inputs = cell.inputs
+        self.nodes = cell.nodes
+        self.steps = cell.steps
+        self.concat = cell.concat
+
+    def reset(self):
+        self.op_outputs = [FrameQueue() for _ in self._ops]
+        self.states = {i: FrameQueue() for i in self.concat}
+
+    def forward(self, s0, start0, s1, start1):
+        states = [self.preprocess0(s0, start0), self.preprocess1(s1, start1)]
+        for i in range(self.steps):
+            ks = [k for k, node in enumerate(self.nodes) if node == i]
+            if not ks:
+                # all ops of the node were zero
+                h, h_start = states[0]
+                states.append((None if h is None else torch.zeros_like(h), h_start))
+                continue
+            for k in ks:
+                self.op_outputs[k].push(*self._ops[k](*states[self.inputs[k]]))
+            joined, lo = join([self.op_outputs[k] for k in ks])
+            if joined is None:
+                states.append((None, None))
+                continue
+            h = joined[0]
+            for x in joined[1:]:
+                h = h + x
+            states.append((h, lo))
+        for i in self.concat:
+            self.states[i].push(*states[i])
+        joined, lo = join([self.states[i] for i in self.concat])
+        if joined is None:
+            return None, None
+        return torch.cat(joined, dim=1), lo
+
+
+class IncrementalNetwork(nn.Module):
+    """ Stateful inference of a trained DerivedNetwork over continuous pose
+    streams.
+
+    Every graph conv unit and op keeps the input frames its temporal
+    convolutions still need, so a new frame is computed once per layer instead
+    of once per overlapping window. A window is classified from a running sum
+    of the pooled features of its frames. The cost of an update is O(stride)
+    instead of O(window).
+
+    The frames are computed with their real neighbours instead of the zero
+    padding at the window borders, as if the network ran on the whole recording.
+    Predictions can therefore differ from the windowed ones for windows whose
+    frames near the borders matter. The output lags the input by the radius of
+    the network (delay frames). Networks with attentions that pool over the
+    whole window (Part, Part_Share, Part_Conv, Channel and Joint attention) are
+    rejected.
+
+    Args:
+        model (DerivedNetwork or FrozenNetwork): trained network
+        connect_joint (array): parent joint of every joint, Graph.connect_joint
+        window (int): frames per window, T of the training data
+        stride (int): frames between two predictions of a stream
+    """
+    def __init__(self, model, connect_joint, window=40, stride=10):
+        super(IncrementalNetwork, self).__init__()
+        frozen = model if isinstance(model, FrozenNetwork) else freeze(model)
+        check_temporally_local(frozen)
+        self.stem = IncrementalStem(frozen.stem)
+        self.cells = nn.ModuleList([IncrementalCell(cell) for cell in frozen.cells])
+        self.classifier = frozen.classifier
+        self.register_buffer('conn', torch.as_tensor(connect_joint).long())
+        self.window = window
+        self.stride = stride
+        self.reset()
+
+    def reset(self):
+        # start new streams
+        self.frames_in = 0
+        self.last = None
+        self.stem.reset()
+        for cell in self.cells:
+            cell.reset()
+        self.features = FrameQueue()
+        self.sum = None
+        self.delay = None
+
+    def multi_input(self, x):
+        # joint, bone and motion inputs like dataset.feeder.multi_input, the motion of a frame needs the next one
+        start = self.frames_in - (0 if self.last is None else 1)
+        if self.last is not None:
+            x = torch.cat([self.last, x], dim=2)
+        self.last = x[:, :, -1:]
+        joint = x[:, :, :-1]
+        bone = torch.zeros_like(joint)
+        n = self.conn.size(0)
+        bone[:, :, :, :n] = joint[:, :, :, :n] - joint[:, :, :, self.conn]
+        motion = x[:, :, 1:] - x[:, :, :-1]
+        return torch.stack([joint, bone, motion], dim=1), start
+
+    def forward(self, frames):
+        """ Push the next frames of N streams.
+
+        Args:
+            frames (Tensor): (N, C, S, V) frames of every stream, normalized like
+                stream.keypoints_to_frame
+
+        Returns:
+            list of (frame, logits) for the windows completed by the new frames,
+            frame is the last frame of the window and logits is (N, num_classes)
+        """
+        frames = frames.float()
+        x, start = self.multi_input(frames)
+        self.frames_in += frames.size(2)
+        if x.size(2) == 0:
+            return []
+
+        s1, start1 = self.stem(x, start)
+        s0, start0 = s1, start1
+        for cell in self.cells:
+            (s0, start0), (s1, start1) = (s1, start1), cell(s0, start0, s1, start1)
+        if s1 is None:
+            return []
+
+        outputs = []
+        # per frame global pooling, the window pooling is the mean of its frames
+        features = s1.mean(dim=3)
+        for t in range(features.size(2)):
+            frame = start1 + t
+            f = features[:, :, t]
+            self.sum = f if self.sum is None else self.sum + f
+            self.features.push(f[:, :, None, None], frame)
+            if len(self.features) > self.window:
+                self.sum = self.sum - self.features.pop(self.features.start, self.features.start + 1)[:, :, 0, 0]
+            if frame % self.window == 0:
+                # resum once per window against the rounding drift of the running sum
+                self.sum = self.features.data[:, :, :, 0].sum(dim=2)
+            if frame + 1 >= self.window and (frame + 1 - self.window) % self.stride == 0:
+                outputs.append((frame, self.classifier(self.sum / self.window)))
+        self.delay = self.frames_in - 1 - (start1 + features.size(2) - 1)
+        return outputs
@@ -2,7 +2,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 
 from operations import *
 from utils import drop_path, Genotype, DecayScheduler
@@ -12,11 +14,25 @@ sys.path.append("..")
 from args import args, beta_decay_scheduler
 
 
+def channel_shuffle(x, groups):
+    batchsize, num_channels, height, width = x.data.size()
+    channels_per_group = num_channels // groups
+
+    x = x.view(batchsize, groups, channels_per_group, height, width)
+    x = torch.transpose(x, 1, 2).contiguous()
+    return x.view(batchsize, -1, height, width)
+
+
 class MixedOp(nn.Module):
     def __init__(self, C, stride, PRIMITIVES):
         super(MixedOp, self).__init__()
         self._ops = nn.ModuleList()
         self.stride = stride
+        # only 1/k of the channels go through the candidates, the rest bypass them
+        self.k = args.partial_channel
+        assert C % self.k == 0, 'channels must be divisible by --partial_channel'
+        # weight of the auxiliary skip, None follows beta_decay_scheduler
+        self.decay_rate = None
 
         if args.auxiliary_skip:
             if self.stride == 2:
@@ -33,17 +49,81 @@ class MixedOp(nn.Module):
             else:
                 assert False, 'Unknown auxiliary operation'
 
-        for primitive in PRIMITIVES:
-            op = OPS[primitive](C, stride,  False)
+        # candidates in HEADS differ only in the attention head, they can share one trunk
+        self._shared = [args.share_trunk and primitive in HEADS for primitive in PRIMITIVES]
+        if any(self._shared):
+            self.trunk = OPS['Basic_bottleneck'](C // self.k, stride, False)
+
+        for primitive, shared in zip(PRIMITIVES, self._shared):
+            if shared:
+                op = HEADS[primitive](C // self.k)
+            else:
+                op = OPS[primitive](C // self.k, stride,  False)
             if 'pool' in primitive:
-                op = nn.Sequential(op, nn.BatchNorm2d(C, affine=False))
+                op = nn.Sequential(op, nn.BatchNorm2d(C // self.k, affine=False))
             self._ops.append(op)
+        # candidates whose output is always zero, they are never evaluated
+        self._zero = [isinstance(op, Zero) for op in self._ops]
+
+    def forward(self, x, weights, A, active=None):
+        return self.dispatch(x, weights, A, active)()
+
+    def dispatch(self, x, weights, A, active=None, pool=None):
+        """ Start the candidates and return a function that sums their outputs.
+
+        Args:
+            active (list): indices of the sampled candidates, the others are
+                not evaluated
+            pool (Executor): runs the candidates concurrently, sequential and
+                lazy if None
+        """
+        if active is None:
+            active = range(len(self._ops))
+        if self.k > 1:
+            x_op, x_bypass = torch.split(x, [x.size(1) // self.k, x.size(1) - x.size(1) // self.k], dim=1)
+        else:
+            x_op = x
+        live = [i for i in active if not self._zero[i]]
+        if any(self._shared[i] for i in live):
+            trunk = self.trunk(x_op, A)
+
+        def run(i):
+            return self._ops[i](trunk) if self._shared[i] else self._ops[i](x_op,A)
+
+        if pool is not None:
+            # grad mode is thread local
+            grad_enabled = torch.is_grad_enabled()
+
+            def task(i):
+                with torch.set_grad_enabled(grad_enabled):
+                    return run(i)
+            futures = [pool.submit(task, i) for i in live]
+            outputs = lambda: (f.result() for f in futures)
+        else:
+            outputs = lambda: (run(i) for i in live)
 
-    def forward(self, x, weights, A):
-        res = sum(w * op(x,A) for w, op in zip(weights, self._ops))
-        if args.auxiliary_skip:
-            res += self.auxiliary_op(x) * beta_decay_scheduler.decay_rate
-        return res
+        def reduce():
+            if live:
+                res = sum(weights[i] * out for i, out in zip(live, outputs()))
+            else:
+                res = x_op.new_zeros(x_op[:, :, ::self.stride, ::self.stride].size())
+            if self.k > 1:
+                res = torch.cat([res, x_bypass], dim=1)
+            # the skip is added in the channel order of x, before the partial-channel shuffle
+            decay_rate = beta_decay_scheduler.decay_rate if self.decay_rate is None else self.decay_rate
+            if args.auxiliary_skip and decay_rate != 0:
+                res += self.auxiliary_op(x) * decay_rate
+            if self.k > 1:
+                res = channel_shuffle(res, self.k)
+            return res
+        return reduce
+
+    def prune(self, keep):
+        self._ops = nn.ModuleList([self._ops[i] for i in keep])
+        self._shared = [self._shared[i] for i in keep]
+        self._zero = [self._zero[i] for i in keep]
+        if not any(self._shared) and hasattr(self, 'trunk'):
+            del self.trunk
 
 
 class Cell(nn.Module):
@@ -76,18 +156,32 @@ class Cell(nn.Module):
                 self._ops.append(op)
                 edge_index += 1
 
-    def forward(self, s0, s1, w1, drop_prob=0.):
+    def forward(self, s0, s1, w1, drop_prob=0., w2=None, active=None, pool=None):
         s0 = self.preprocess0(s0,self.AH)
         s1 = self.preprocess1(s1,self.AH)
 
         states = [s0,s1]
         offset = 0
         for i in range(self._steps):
-            if drop_prob > 0. and self.training:
-
-                s = sum(drop_path(self._ops[offset + j](h, w1[offset + j]), drop_prob) for j, h in enumerate(states))
+            def op_inputs(j, h):
+                return h, w1[offset + j], self.AH, None if active is None else active[offset + j]
+
+            def edge(j, out):
+                if drop_prob > 0. and self.training:
+                    out = drop_path(out, drop_prob)
+                if w2 is not None:
+                    out = w2[offset + j] * out
+                return out
+
+            if pool is not None:
+                # all candidates of all edges into this node run concurrently
+                outputs = [self._ops[offset + j].dispatch(*op_inputs(j, h), pool=pool) for j, h in enumerate(states)]
+                s = sum(edge(j, out()) for j, out in enumerate(outputs))
+            elif args.grad_checkpoint == 'mixedop' and self.training and torch.is_grad_enabled():
+                s = sum(edge(j, checkpoint(self._ops[offset + j], *op_inputs(j, h), use_reentrant=False))
+                        for j, h in enumerate(states))
             else:
-                s = sum(self._ops[offset + j](h,  w1[offset + j], self.AH) for j, h in enumerate(states))
+                s = sum(edge(j, self._ops[offset + j](*op_inputs(j, h))) for j, h in enumerate(states))
 
             offset += len(states)
             states.append(s)
@@ -98,21 +192,22 @@ class ResGCN_Input_Branch(nn.Module):
     def __init__(self, structure, num_channel, A, **kwargs):
         super(ResGCN_Input_Branch, self).__init__()
         self.Ah = A
+        # with groups > 1 the branch runs that many input streams side by side, all widths are per stream
+        g = kwargs.get('groups', 1)
 
-        module_list = [ResGCN_Module(num_channel, 64, 'Basic', self.Ah, initial=True, **kwargs)]
-        module_list += [ResGCN_Module(64, 64, 'Basic', self.Ah, initial=True, **kwargs) for _ in range(structure[0] - 1)]
-        module_list += [ResGCN_Module(64, 64, 'Basic', self.Ah, **kwargs) for _ in range(structure[1] - 1)]
-        module_list += [ResGCN_Module(64, 16, 'Basic', self.Ah, **kwargs)]
+        module_list = [ResGCN_Module(num_channel*g, 64*g, 'Basic', self.Ah, initial=True, **kwargs)]
+        module_list += [ResGCN_Module(64*g, 64*g, 'Basic', self.Ah, initial=True, **kwargs) for _ in range(structure[0] - 1)]
+        module_list += [ResGCN_Module(64*g, 64*g, 'Basic', self.Ah, **kwargs) for _ in range(structure[1] - 1)]
+        module_list += [ResGCN_Module(64*g, 16*g, 'Basic', self.Ah, **kwargs)]
 
-        self.bn = nn.BatchNorm2d(num_channel)
-        self.bn.cuda()
+        self.bn = nn.BatchNorm2d(num_channel*g)
         self.layers = nn.ModuleList(module_list)
 
 
     def forward(self, x):
 
         N, C, T, V, M = x.size()
-        x = x.float().to('cuda')
+        x = x.float()
         x = self.bn(x.permute(0,4,1,2,3).contiguous().view(N*M, C, T, V))
         for layer in self.layers:
 
@@ -121,15 +216,20 @@ class ResGCN_Input_Branch(nn.Module):
         return x
 
 class Input_GCN(nn.Module):
-    def __init__(self, A):
+    def __init__(self, A, fused=False):
         super(Input_GCN, self).__init__()
         self.Aa = A
+        self.num_input = 3
+        self.fused = fused
 
-        # input branches
-        self.input_branches = nn.ModuleList([
-            ResGCN_Input_Branch([1,2,2,2], 3, self.Aa)
-            for _ in range(3)
-        ])
+        # input branches (joint, bone and motion), fused runs them as one branch of grouped convolutions
+        if fused:
+            self.input_branch = ResGCN_Input_Branch([1,2,2,2], 3, self.Aa, groups=self.num_input)
+        else:
+            self.input_branches = nn.ModuleList([
+                ResGCN_Input_Branch([1,2,2,2], 3, self.Aa)
+                for _ in range(self.num_input)
+            ])
 
         # main stream
 
@@ -146,6 +246,10 @@ class Input_GCN(nn.Module):
         N, I, C, T, V, M = x.size()
 
         # input branches
+        if self.fused:
+            # the streams are stacked along the channels, in the same order as the concatenation below
+            return self.input_branch(x.reshape(N, I*C, T, V, M))
+
         x_cat = []
 
         for i, branch in enumerate(self.input_branches):
@@ -155,6 +259,33 @@ class Input_GCN(nn.Module):
 
         return x
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # convert between the fused (input_branch.*) and the per-stream (input_branches.{i}.*) layout
+        fused, split = prefix + 'input_branch.', prefix + 'input_branches.{}.'
+        if self.fused:
+            for key in [k for k in state_dict if k.startswith(split.format(0))]:
+                name = key[len(split.format(0)):]
+                parts = [state_dict.pop(split.format(i) + name) for i in range(self.num_input)]
+                if name.endswith('.edge'):
+                    state_dict[fused + name] = torch.stack(parts)
+                elif name.endswith('.A') or name.endswith('num_batches_tracked'):
+                    state_dict[fused + name] = parts[0]
+                else:
+                    state_dict[fused + name] = torch.cat(parts)
+        else:
+            for key in [k for k in state_dict if k.startswith(fused)]:
+                name = key[len(fused):]
+                value = state_dict.pop(key)
+                if name.endswith('.edge'):
+                    parts = value.unbind(0)
+                elif name.endswith('.A') or name.endswith('num_batches_tracked'):
+                    parts = [value] * self.num_input
+                else:
+                    parts = value.chunk(self.num_input)
+                for i, part in enumerate(parts):
+                    state_dict[split.format(i) + name] = part
+        super(Input_GCN, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 class Network(nn.Module):
 
   def __init__(self, C, A, num_classes, data_shape, layers, criterion, primitives, steps=4,
@@ -168,6 +299,8 @@ class Network(nn.Module):
     self._multiplier = multiplier
     self.drop_path_prob = drop_path_prob
     self.args = args
+    # Gumbel softmax temperature of the sampled search, annealed by train_search
+    self.tau = args.tau_max
     self.data_shape = data_shape
 
     nn.Module.PRIMITIVES = primitives
@@ -175,7 +308,12 @@ class Network(nn.Module):
 
     C_curr = stem_multiplier*C
 
-    self.stem = Input_GCN(self.AB)
+    self.stem = Input_GCN(self.AB, fused=args.fuse_stem)
+    # a frozen stem is kept in eval mode and gets no gradients, its output can be cached
+    self.stem_frozen = False
+    # threads running the candidate ops of a node concurrently, None runs them sequentially
+    self.op_pool = None
+    self.set_op_threads(args.parallel_ops)
 
     C_prev_prev, C_prev, C_curr = C_curr, C_curr, C
 
@@ -195,9 +333,10 @@ class Network(nn.Module):
     self._initialize_alphas()
 
   def new(self):
-        model_new = Network(self._C, self._num_classes, self._layers,
-                            self._criterion, self.PRIMITIVES,
-                            drop_path_prob=self.drop_path_prob)
+        model_new = Network(self._C, self.AB, self._num_classes, self.data_shape, self._layers,
+                            self._criterion, self.PRIMITIVES, steps=self._steps,
+                            multiplier=self._multiplier, drop_path_prob=self.drop_path_prob,
+                            args=self.args)
         if not self.args.disable_cuda:
             model_new = model_new.cuda()
         for x, y in zip(model_new.arch_parameters(), self.arch_parameters()):
@@ -205,7 +344,14 @@ class Network(nn.Module):
         return model_new
 
   def forward(self, input, discrete=False):
-        s0 = s1 = self.stem(input)
+        # 4-D inputs are cached stem features (N*M, C, T, V)
+        if input.dim() == 4:
+            s0 = s1 = input
+        elif self.stem_frozen:
+            with torch.no_grad():
+                s0 = s1 = self.stem(input)
+        else:
+            s0 = s1 = self.stem(input)
         for i, cell in enumerate(self.cells):
             if cell.reduction:
                 if discrete:
@@ -218,12 +364,59 @@ class Network(nn.Module):
                 else:
                     w1 = F.softmax(self.alphas_normal, dim=-1)
 
-            s0, s1 = s1, cell(s0, s1,  w1, self.drop_path_prob)
+            active = None
+            if self.args.sample_ops > 0 and not discrete:
+                w1, active = self._sample_weights(self.alphas_reduce if cell.reduction else self.alphas_normal)
+            elif discrete:
+                # skip the candidates with a zero weight
+                active = [[i for i, nonzero in enumerate(row) if nonzero] for row in (w1 != 0).tolist()]
+
+            w2 = None
+            if self.args.partial_channel > 1:
+                w2 = self._edge_weights(self.betas_reduce if cell.reduction else self.betas_normal)
+
+            if self.args.grad_checkpoint == 'cell' and self.training and torch.is_grad_enabled():
+                s0, s1 = s1, checkpoint(cell, s0, s1, w1, self.drop_path_prob, w2, active, use_reentrant=False)
+            else:
+                # saved tensor hooks of the checkpointing are thread local, it does not mix with the op pool
+                pool = self.op_pool if self.args.grad_checkpoint == 'none' else None
+                s0, s1 = s1, cell(s0, s1,  w1, self.drop_path_prob, w2, active, pool)
         out = self.global_pooling(s1)
         logits = self.classifier(out.view(out.size(0), -1))
 
         return logits
 
+  def __getstate__(self):
+        # copies, e.g. the snapshots of analyze.BackgroundAnalyzer, run their ops sequentially and
+        # build their own flat weights in architect.flat_parameters
+        state = self.__dict__.copy()
+        state['op_pool'] = None
+        state.pop('_flat_parameters', None)
+        return state
+
+  def set_decay_rate(self, decay_rate):
+    # fixes the weight of the auxiliary skip of every MixedOp, None follows beta_decay_scheduler again
+    for m in self.modules():
+        if isinstance(m, MixedOp):
+            m.decay_rate = decay_rate
+
+  def set_op_threads(self, num_threads):
+    if self.op_pool is not None:
+        self.op_pool.shutdown()
+    self.op_pool = ThreadPoolExecutor(num_threads) if num_threads > 1 else None
+
+  def freeze_stem(self):
+    for p in self.stem.parameters():
+        p.requires_grad = False
+    self.stem.eval()
+    self.stem_frozen = True
+
+  def train(self, mode=True):
+    super(Network, self).train(mode)
+    if self.stem_frozen:
+        self.stem.eval()
+    return self
+
   def _loss(self, input, target ):
         logits = self(input)
         return self._criterion(logits,target.long())
@@ -244,9 +437,102 @@ class Network(nn.Module):
             self.alphas_reduce,
         ]
 
+        # edge normalization of the partial-channel search
+        if self.args.partial_channel > 1:
+            if self.args.disable_cuda:
+                self.betas_normal = Variable(1e-3 * torch.randn(k), requires_grad=True)
+                self.betas_reduce = Variable(1e-3 * torch.randn(k), requires_grad=True)
+            else:
+                self.betas_normal = Variable(1e-3 * torch.randn(k).cuda(), requires_grad=True)
+                self.betas_reduce = Variable(1e-3 * torch.randn(k).cuda(), requires_grad=True)
+            self._arch_parameters += [
+                self.betas_normal,
+                self.betas_reduce,
+            ]
+
   def arch_parameters(self):
         return self._arch_parameters
 
+  def _sample_weights(self, alphas):
+        # straight-through Gumbel top-k: the drawn candidates get weight 1/k in the forward
+        # pass and the gradient of the relaxed softmax in the backward pass
+        k = min(self.args.sample_ops, alphas.size(-1))
+        logits = alphas
+        if self.training:
+            logits = alphas - torch.empty_like(alphas).exponential_().log()
+        soft = F.softmax(logits / self.tau, dim=-1)
+        index = logits.topk(k, dim=-1)[1]
+        hard = torch.zeros_like(soft).scatter_(-1, index, 1. / k)
+        return hard - soft.detach() + soft, index.tolist()
+
+  def prune(self, num=0, threshold=0.):
+        """ Permanently remove the weakest candidates of every edge.
+
+        Args:
+            num (int): number of candidates removed per edge
+            threshold (float): every edge loses as many of its weakest
+                candidates as the edge with the most softmax weights below this
+                value, so that the alphas stay rectangular. Edges with fewer
+                candidates below it also lose some above it.
+
+        Returns:
+            list with the kept op indices of every edge, None if nothing was
+            removed. 'none' is never removed and at least one other candidate
+            is kept on every edge.
+        """
+        weights = F.softmax(self.alphas_normal, dim=-1).data.cpu().numpy()
+        primitives = self.PRIMITIVES['primitives_normal']
+        removable = [[k for k in range(len(w)) if primitives[e][k] != 'none'] for e, w in enumerate(weights)]
+
+        if threshold > 0:
+            num = max(num, max(sum(weights[e][k] < threshold for k in r) for e, r in enumerate(removable)))
+        num = min(num, min(len(r) for r in removable) - 1)
+        if num <= 0:
+            return None
+
+        keep = []
+        for e, r in enumerate(removable):
+            weakest = sorted(r, key=lambda k: weights[e][k])[:num]
+            keep.append([k for k in range(len(weights[e])) if k not in weakest])
+        self._prune_ops(keep)
+        return keep
+
+  def prune_to(self, primitives):
+        # prune to the candidates of a pruned search space, e.g. from a checkpoint
+        keep = [[ops.index(name) for name in new_ops]
+                for ops, new_ops in zip(self.PRIMITIVES['primitives_normal'][:len(self.cells[0]._ops)],
+                                        primitives['primitives_normal'])]
+        self._prune_ops(keep)
+        return keep
+
+  def _prune_ops(self, keep):
+        for cell in self.cells:
+            for e, op in enumerate(cell._ops):
+                op.prune(keep[e])
+
+        self.PRIMITIVES = OrderedDict(
+            (key, [[ops[e][k] for k in keep[e]] for e in range(len(keep))] + ops[len(keep):])
+            for key, ops in self.PRIMITIVES.items())
+        for cell in self.cells:
+            cell.primitives = self.PRIMITIVES['primitives_normal']
+
+        index = torch.LongTensor(keep).to(self.alphas_normal.device)
+        self.alphas_normal = Variable(self.alphas_normal.data.gather(1, index), requires_grad=True)
+        self.alphas_reduce = Variable(self.alphas_reduce.data.gather(1, index), requires_grad=True)
+        self._arch_parameters = [self.alphas_normal, self.alphas_reduce] + self._arch_parameters[2:]
+
+  def _edge_weights(self, betas):
+        # softmax over the edges entering each node
+        weights = []
+        n = 2
+        start = 0
+        for i in range(self._steps):
+            end = start + n
+            weights.append(F.softmax(betas[start:end], dim=-1))
+            start = end
+            n += 1
+        return torch.cat(weights)
+
   def genotype(self):
 
         def _parse(w1, normal=True):
@@ -261,15 +547,15 @@ class Network(nn.Module):
 
                 try:
                     edges = sorted(range(i + 2), key=lambda x: -max(
-                        W[x][k] for k in range(len(W[x])) if k != PRIMITIVES[x].index('none')))[:2]
+                        W[x][k] for k in range(len(W[x])) if k != PRIMITIVES[start + x].index('none')))[:2]
                 except ValueError:  # This error happens when the 'none' op is not present in the ops
                     edges = sorted(range(i + 2), key=lambda x: -max(W[x][k] for k in range(len(W[x]))))[:2]
 
                 for j in edges:
                     k_best = None
                     for k in range(len(W[j])):
-                        if 'none' in PRIMITIVES[j]:
-                            if k != PRIMITIVES[j].index('none'):
+                        if 'none' in PRIMITIVES[start + j]:
+                            if k != PRIMITIVES[start + j].index('none'):
                                 if k_best is None or W[j][k] > W[j][k_best]:
                                     k_best = k
                         else:
@@ -280,8 +566,14 @@ class Network(nn.Module):
                 n += 1
             return gene
 
-        gene_normal = _parse(F.softmax(self.alphas_normal, dim=-1).data.cpu().numpy(), True)
-        gene_reduce = _parse(F.softmax(self.alphas_reduce, dim=-1).data.cpu().numpy(), False)
+        weights_normal = F.softmax(self.alphas_normal, dim=-1)
+        weights_reduce = F.softmax(self.alphas_reduce, dim=-1)
+        if self.args.partial_channel > 1:
+            weights_normal = weights_normal * self._edge_weights(self.betas_normal)[:, None]
+            weights_reduce = weights_reduce * self._edge_weights(self.betas_reduce)[:, None]
+
+        gene_normal = _parse(weights_normal.data.cpu().numpy(), True)
+        gene_reduce = _parse(weights_reduce.data.cpu().numpy(), False)
 
         concat = range(2 + self._steps - self._multiplier, self._steps + 2)
         genotype = Genotype(
@@ -292,7 +584,13 @@ class Network(nn.Module):
 
 def init_param(modules):
     for m in modules:
-        if isinstance(m, nn.Conv1d) or isinstance(m, nn.Conv2d):
+        if isinstance(m, nn.Conv2d) and m.groups > 1:
+            # initialize every group like a separate convolution
+            for w in m.weight.data.chunk(m.groups):
+                nn.init.kaiming_normal_(w, mode='fan_out', nonlinearity='relu')
+            if m.bias is not None:
+                nn.init.constant_(m.bias, 0)
+        elif isinstance(m, nn.Conv1d) or isinstance(m, nn.Conv2d):
             nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
             if m.bias is not None:
                 nn.init.constant_(m.bias, 0)
@@ -27,13 +27,16 @@ class ResGCN_Module(nn.Module):
         else:
             module_res, block_res = False, True
 
+        # groups > 1 runs that many independent streams stacked along the channels
+        groups = kwargs.get('groups', 1)
+
         if not module_res:
             self.residual = lambda x: 0
         elif stride == 1 and in_channels == out_channels:
             self.residual = lambda x: x
         else:
             self.residual = nn.Sequential(
-                nn.Conv2d(in_channels, out_channels, 1, (stride,1)),
+                nn.Conv2d(in_channels, out_channels, 1, (stride,1), groups=groups),
                 nn.BatchNorm2d(out_channels),
             )
 
@@ -42,10 +45,13 @@ class ResGCN_Module(nn.Module):
 
         self.scn = spatial_block(in_channels, out_channels, max_graph_distance, block_res, **kwargs)
         self.tcn = temporal_block(out_channels, temporal_window_size, stride, block_res, **kwargs)
-        self.edge = nn.Parameter(torch.ones_like(A))
+        if groups > 1:
+            self.edge = nn.Parameter(torch.ones(groups, *A.size(), dtype=A.dtype))
+        else:
+            self.edge = nn.Parameter(torch.ones_like(A))
 
     def forward(self, x, A):
-        A = A.cuda()
+        A = A.to(x.device)
         return self.tcn(self.scn(x, A*self.edge), self.residual(x))
 
 
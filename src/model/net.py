@@ -2,6 +2,9 @@ import torch
 from torch import nn
 
 from modules import ResGCN_Module
+from operations import OPS, HEADS, Identity, Basic_net
+from model_search import Input_GCN
+from utils import drop_path
 
 
 class ResGCN_Input_Branch(nn.Module):
@@ -24,4 +27,126 @@ class ResGCN_Input_Branch(nn.Module):
         for layer in self.layers:
             x = layer(x, self.A)
 
-        return x
\ No newline at end of file
+        return x
+
+class DerivedCell(nn.Module):
+    def __init__(self, genotype, C_prev_prev, C_prev, C, A):
+        super(DerivedCell, self).__init__()
+        self.AH = A
+
+        self.preprocess0 = Basic_net(C_prev_prev, C, self.AH, kernel_size=[9,2], stride=1)
+        self.preprocess1 = Basic_net(C_prev, C, self.AH, kernel_size=[9,2], stride=1)
+
+        op_names, indices = zip(*genotype.normal)
+        self._op_names = op_names
+        self._steps = len(op_names) // 2
+        self._concat = list(genotype.normal_concat)
+        self.multiplier = len(self._concat)
+        self._indices = indices
+
+        # only the two selected (op, input) pairs of every node are built
+        self._ops = nn.ModuleList([OPS[name](C, 1, True) for name in op_names])
+
+    def forward(self, s0, s1, drop_prob=0.):
+        s0 = self.preprocess0(s0, self.AH)
+        s1 = self.preprocess1(s1, self.AH)
+
+        states = [s0, s1]
+        for i in range(self._steps):
+            s = 0
+            for k in (2*i, 2*i + 1):
+                op = self._ops[k]
+                h = op(states[self._indices[k]], self.AH)
+                if self.training and drop_prob > 0. and not isinstance(op, Identity):
+                    h = drop_path(h, drop_prob)
+                s = s + h
+            states.append(s)
+        return torch.cat([states[i] for i in self._concat], dim=1)
+
+
+class DerivedNetwork(nn.Module):
+    """ Discrete network of a searched genotype, built with the same stem,
+    cell layout and classifier as the search Network of model_search.
+
+    Args:
+        C (int): channels of the cell nodes, the stem outputs 3*C
+        A (Tensor): adjacency of the skeleton graph
+        num_classes (int): number of behaviour classes
+        layers (int): number of cells
+        genotype (Genotype): genotypes.Genotype or utils.Genotype, only the
+            normal cell is used
+        fuse_stem (bool): see Input_GCN
+        drop_path_prob (float): drop path probability during training
+    """
+    def __init__(self, C, A, num_classes, layers, genotype, fuse_stem=False, drop_path_prob=0.0):
+        super(DerivedNetwork, self).__init__()
+        self._layers = layers
+        self.genotype = genotype
+        self.drop_path_prob = drop_path_prob
+        self.AB = A
+
+        self.stem = Input_GCN(self.AB, fused=fuse_stem)
+
+        C_prev_prev, C_prev, C_curr = 3*C, 3*C, C
+        self.cells = nn.ModuleList()
+        for i in range(layers):
+            cell = DerivedCell(genotype, C_prev_prev, C_prev, C_curr, self.AB)
+            self.cells += [cell]
+            C_prev_prev, C_prev = C_prev, cell.multiplier*C_curr
+
+        self.global_pooling = nn.AdaptiveAvgPool2d(1)
+        self.classifier = nn.Linear(C_prev, num_classes)
+
+    def forward(self, input):
+        # 4-D inputs are cached stem features (N*M, C, T, V)
+        s0 = s1 = input if input.dim() == 4 else self.stem(input)
+        for cell in self.cells:
+            s0, s1 = s1, cell(s0, s1, self.drop_path_prob)
+        out = self.global_pooling(s1)
+        return self.classifier(out.view(out.size(0), -1))
+
+
+def inherit_supernet_weights(model, state_dict, primitives):
+    """ Load the weights of the selected ops of a search Network into a
+    DerivedNetwork, together with its stem, preprocessing and classifier.
+
+    Args:
+        model (DerivedNetwork): network of a genotype of the search
+        state_dict (dict): state_dict of the search Network
+        primitives (list): candidate ops of every edge of the search
+            Network, primitives['primitives_normal'] of a (pruned) space
+
+    Returns:
+        list with the keys of model that were not inherited, e.g. affine
+        batch norm parameters that the search ops do not have
+    """
+    state = {k: v for k, v in state_dict.items() if k.startswith(('stem.', 'classifier.'))}
+    for l, cell in enumerate(model.cells):
+        prefix = 'cells.{}.'.format(l)
+        for k, v in state_dict.items():
+            if k.startswith((prefix + 'preprocess0.', prefix + 'preprocess1.')):
+                state[k] = v
+
+        offset = 0
+        for i in range(cell._steps):
+            for m in (2*i, 2*i + 1):
+                name, j = cell._op_names[m], cell._indices[m]
+                src = prefix + '_ops.{}.'.format(offset + j)
+                dst = prefix + '_ops.{}.'.format(m)
+                op = src + '_ops.{}.'.format(primitives[offset + j].index(name))
+                trunk = src + 'trunk.'
+                shared = name in HEADS and any(k.startswith(trunk) for k in state_dict)
+                for k, v in state_dict.items():
+                    if shared and k.startswith(trunk):
+                        state[dst + k[len(trunk):]] = v
+                    elif k.startswith(op):
+                        state[dst + ('att.' if shared else '') + k[len(op):]] = v
+            offset += 2 + i
+
+    own = model.state_dict()
+    mismatched = [k for k, v in state.items() if k in own and own[k].shape != v.shape]
+    if mismatched:
+        raise ValueError('Shapes of the search network do not match the derived network '
+                         '(searched with --partial_channel?): {}'.format(mismatched))
+    missing, _ = model.load_state_dict(state, strict=False)
+    return missing
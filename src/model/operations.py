@@ -44,6 +44,18 @@ OPS = {
 
 }
 
+# attention heads of the candidates built on a Spatial/Temporal_Bottleneck_Block trunk,
+# used when the candidates of an edge share one trunk (--share_trunk)
+HEADS = {
+    'Part_Att_bottleneck': lambda C: Part_Att(C, parts),
+    'Part_Share_Att_bottleneck': lambda C: Part_Share_Att(C, parts, affine=True),
+    'Part_Conv_Att_bottleneck': lambda C: Part_Conv_Att(C, parts),
+    'Joint_Att_bottleneck': lambda C: Joint_Att(C, parts),
+    'Frame_Att_bottleneck': lambda C: Frame_Att(C),
+    'Channel_Att_bottleneck': lambda C: Channel_Att(C),
+    'Basic_bottleneck': lambda C: Identity(),
+}
+
 class NoiseOp(nn.Module):
     def __init__(self, stride, mean, std):
         super(NoiseOp, self).__init__()
@@ -113,7 +125,7 @@ class Identity(nn.Module):
   def __init__(self):
     super(Identity, self).__init__()
 
-  def forward(self, x):
+  def forward(self, x, AS=None):
     return x
 
 
@@ -150,7 +162,8 @@ class Part_Att(nn.Module):
         super(Part_Att, self).__init__()
 
         self.parts = parts
-        self.joints = get_corr_joints(parts)
+        # not in the state dict, but moved with the module
+        self.register_buffer('joints', get_corr_joints(parts), persistent=False)
 
         inter_channel = channel // 4
 
@@ -171,10 +184,8 @@ class Part_Att(nn.Module):
         res = x
 
         x_att = self.softmax(self.fcn(x).view(N, C, len(self.parts)))
-        x_att = torch.split(x_att, 1, dim=-1)
-        x_att = [x_att[self.joints[i]].expand_as(x[:,:,:,i]) for i in range(V)]
-        x_att = torch.stack(x_att, dim=-1)
-        return self.relu(self.bn(x * x_att) + res)
+        x_att = x_att[:, :, self.joints]
+        return self.relu(self.bn(x * x_att[:, :, None, :]) + res)
 
 
 class Part_Share_Att(nn.Module):
@@ -182,15 +193,18 @@ class Part_Share_Att(nn.Module):
         super(Part_Share_Att, self).__init__()
 
         self.parts = parts
-        self.joints = get_corr_joints(parts)
+        # not in the state dict, but moved with the module
+        index, mask = get_part_layout(parts)
+        self.register_buffer('joints', get_corr_joints(parts), persistent=False)
+        self.register_buffer('index', index, persistent=False)
+        self.register_buffer('mask', mask, persistent=False)
 
         inter_channel = channel // 4
 
+        # applied once to all joints, ReLU and pooling are done per part in part_pool_features
         self.part_pool = nn.Sequential(
             nn.Conv2d(channel, inter_channel, kernel_size=1),
             nn.BatchNorm2d(inter_channel,affine=affine),
-            nn.ReLU(inplace=True),
-            nn.AdaptiveAvgPool2d(1),
         )
 
         self.fcn = nn.Sequential(
@@ -207,13 +221,15 @@ class Part_Share_Att(nn.Module):
     def forward(self, x):
         N, C, T, V = x.size()
         res = x
+        P, L = self.index.size()
 
-        x_split = [self.part_pool(x[:,:,:,part]) for part in self.parts]
-        x_att = self.softmax(self.fcn(sum(x_split)).view(N, C, len(self.parts)))
-        x_att = torch.split(x_att, 1, dim=-1)
-        x_att = [x_att[self.joints[i]].expand_as(x[:,:,:,i]) for i in range(V)]
-        x_att = torch.stack(x_att, dim=-1)
-        return self.relu(self.bn(x * x_att) + res)
+        # (N, C', T, V) -> (N, P, C', T, L)
+        x_part = self.part_pool[0](x)[:, :, :, self.index.view(-1)]
+        x_part = x_part.view(N, -1, T, P, L).permute(0, 3, 1, 2, 4)
+        x_pool = part_pool_features(x_part, self.part_pool[1], self.mask).sum(dim=1)
+        x_att = self.softmax(self.fcn(x_pool[:, :, None, None]).view(N, C, P))
+        x_att = x_att[:, :, self.joints]
+        return self.relu(self.bn(x * x_att[:, :, None, :]) + res)
 
 
 class Part_Conv_Att(nn.Module):
@@ -221,16 +237,19 @@ class Part_Conv_Att(nn.Module):
         super(Part_Conv_Att, self).__init__()
 
         self.parts = parts
-        self.joints = get_corr_joints(parts)
+        # not in the state dict, but moved with the module
+        index, mask = get_part_layout(parts)
+        self.register_buffer('joints', get_corr_joints(parts), persistent=False)
+        self.register_buffer('index', index, persistent=False)
+        self.register_buffer('mask', mask, persistent=False)
 
         inter_channel = channel // 4
 
-        self.part_pool = nn.ModuleList([nn.Sequential(
-            nn.Conv2d(channel, inter_channel, kernel_size=1),
-            nn.BatchNorm2d(inter_channel,affine=affine),
-            nn.ReLU(inplace=True),
-            nn.AdaptiveAvgPool2d(1),
-        ) for _ in range(len(self.parts))])
+        # one group per part, ReLU and pooling are done per part in part_pool_features
+        self.part_pool = nn.Sequential(
+            nn.Conv2d(channel*len(self.parts), inter_channel*len(self.parts), kernel_size=1, groups=len(self.parts)),
+            nn.BatchNorm2d(inter_channel*len(self.parts),affine=affine),
+        )
 
         self.fcn = nn.Sequential(
             nn.Conv2d(inter_channel, inter_channel, kernel_size=1),
@@ -246,13 +265,31 @@ class Part_Conv_Att(nn.Module):
     def forward(self, x):
         N, C, T, V = x.size()
         res = x
-
-        x_split = [pool(x[:,:,:,part]) for part, pool in zip(self.parts, self.part_pool)]
-        x_att = self.softmax(self.fcn(sum(x_split)).view(N, C, len(self.parts)))
-        x_att = torch.split(x_att, 1, dim=-1)
-        x_att = [x_att[self.joints[i]].expand_as(x[:,:,:,i]) for i in range(V)]
-        x_att = torch.stack(x_att, dim=-1)
-        return self.relu(self.bn(x * x_att) + res)
+        P, L = self.index.size()
+
+        # (N, C, T, V) -> (N, P*C, T, L) -> (N, P, C', T, L)
+        x_part = x[:, :, :, self.index.view(-1)].view(N, C, T, P, L)
+        x_part = x_part.permute(0, 3, 1, 2, 4).reshape(N, P*C, T, L)
+        x_part = self.part_pool[0](x_part).view(N, P, -1, T, L)
+        x_pool = part_pool_features(x_part, self.part_pool[1], self.mask).sum(dim=1)
+        x_att = self.softmax(self.fcn(x_pool[:, :, None, None]).view(N, C, P))
+        x_att = x_att[:, :, self.joints]
+        return self.relu(self.bn(x * x_att[:, :, None, :]) + res)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints written before the grouped layout keep one conv/BN per part
+        legacy = '{}part_pool.0.0.weight'.format(prefix)
+        if legacy in state_dict:
+            for i, module in enumerate(self.part_pool):
+                for name in list(module.state_dict().keys()):
+                    keys = ['{}part_pool.{}.{}.{}'.format(prefix, p, i, name) for p in range(len(self.parts))]
+                    values = [state_dict.pop(k) for k in keys]
+                    if name == 'num_batches_tracked':
+                        value = values[0]
+                    else:
+                        value = torch.cat(values, dim=0)
+                    state_dict['{}part_pool.{}.{}'.format(prefix, i, name)] = value
+        super(Part_Conv_Att, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 
 class Channel_Att(nn.Module):
@@ -273,7 +310,7 @@ class Channel_Att(nn.Module):
 
     def forward(self, x):
         res = x
-        x_att = self.fcn(x).squeeze()
+        x_att = self.fcn(x).flatten(1)
         return self.relu(self.bn(x * x_att[:, :, None, None]) + res)
 
 class Joint_Att(nn.Module):
@@ -296,7 +333,7 @@ class Joint_Att(nn.Module):
 
     def forward(self, x):
         res = x
-        x_att = self.fcn(torch.transpose(x, 1, 3)).squeeze()
+        x_att = self.fcn(torch.transpose(x, 1, 3)).flatten(1)
         return self.relu(self.bn(x * x_att[:, None, None, :]) + res)
 
 class Frame_Att(nn.Module):
@@ -313,7 +350,7 @@ class Frame_Att(nn.Module):
         res = x
         x_avg = torch.transpose(self.avg_pool(torch.transpose(x, 1, 2)), 1, 2)
         x_max = torch.transpose(self.max_pool(torch.transpose(x, 1, 2)), 1, 2)
-        x_att = self.conv(torch.cat([x_avg, x_max], dim=1)).squeeze()
+        x_att = self.conv(torch.cat([x_avg, x_max], dim=1)).flatten(1)
         return self.relu(self.bn(x * x_att[:, None, :, None]) + res)
 
 def get_corr_joints(parts):
@@ -326,6 +363,80 @@ def get_corr_joints(parts):
                 break
     return torch.Tensor(res).long()
 
+def get_part_layout(parts):
+    # joint index of every (part, slot) pair, parts shorter than the longest one are padded
+    width = max([len(part) for part in parts])
+    index = torch.zeros(len(parts), width).long()
+    mask = torch.zeros(len(parts), width)
+    for i, part in enumerate(parts):
+        index[i, :len(part)] = torch.as_tensor(part).long()
+        mask[i, :len(part)] = 1
+    return index, mask
+
+def part_pool_features(x, bn, mask):
+    """ Average of ReLU(BN(x)) over the joints of every body part.
+
+    Args:
+        x (Tensor): part features of shape (N, P, C, T, L), slot l of part p is
+            a joint of that part where mask[p, l] is 1 and padding otherwise
+        bn (nn.BatchNorm2d): shared by all parts (C channels) or one group of
+            channels per part (P*C channels)
+        mask (Tensor): (P, L) validity of the part slots
+
+    Returns:
+        Tensor of shape (N, P, C). The result and the running statistics are the
+        same as applying bn, ReLU and pooling to every part slice one by one.
+    """
+    N, P, C, T, L = x.size()
+    shared = bn.num_features == C
+    mask = mask.to(x.dtype)
+    count = mask.sum(dim=1)[:, None] * (N * T)
+    m = mask[None, :, None, None, :]
+
+    if bn.training or not bn.track_running_stats:
+        mean = (x * m).sum(dim=(0, 3, 4)) / count
+        var = ((x - mean[None, :, :, None, None]) * m).pow(2).sum(dim=(0, 3, 4)) / count
+        if bn.training and bn.track_running_stats:
+            with torch.no_grad():
+                update_part_running_stats(bn, mean, var * count / (count - 1), shared)
+    else:
+        mean = bn.running_mean.view(-1, C).expand(P, C)
+        var = bn.running_var.view(-1, C).expand(P, C)
+
+    scale = torch.rsqrt(var + bn.eps)
+    if bn.affine:
+        scale = scale * bn.weight.view(-1, C)
+        shift = bn.bias.view(-1, C) - mean * scale
+    else:
+        shift = -mean * scale
+
+    x = torch.relu(x * scale[None, :, :, None, None] + shift[None, :, :, None, None])
+    return (x * m).sum(dim=(3, 4)) / (count / N)
+
+def update_part_running_stats(bn, mean, var, shared):
+    # a shared BN sees the parts one after another, one update per part
+    steps = mean.size(0) if shared else 1
+    factors = []
+    for _ in range(steps):
+        bn.num_batches_tracked += 1
+        if bn.momentum is None:
+            factors.append(1.0 / float(bn.num_batches_tracked))
+        else:
+            factors.append(bn.momentum)
+
+    if not shared:
+        bn.running_mean.mul_(1 - factors[0]).add_(factors[0] * mean.view(-1))
+        bn.running_var.mul_(1 - factors[0]).add_(factors[0] * var.view(-1))
+        return
+
+    keep, weights = 1.0, []
+    for f in reversed(factors):
+        weights.append(f * keep)
+        keep *= 1 - f
+    weights = mean.new_tensor(weights[::-1])[:, None]
+    bn.running_mean.mul_(keep).add_((weights * mean).sum(dim=0))
+    bn.running_var.mul_(keep).add_((weights * var).sum(dim=0))
+
 class Spatial_Bottleneck_Block(nn.Module):
     def __init__(self, in_channels, out_channels, max_graph_distance,  residual=False, reduction=4, affine=True, **kwargs):
         super(Spatial_Bottleneck_Block, self).__init__()
@@ -414,7 +525,7 @@ class Temporal_Bottleneck_Block(nn.Module):
 
 
 class Spatial_Basic_Block(nn.Module):
-    def __init__(self, in_channels, out_channels, max_graph_distance, residual=False, affine=True):
+    def __init__(self, in_channels, out_channels, max_graph_distance, residual=False, affine=True, groups=1):
         super(Spatial_Basic_Block, self).__init__()
 
         if not residual:
@@ -423,11 +534,11 @@ class Spatial_Basic_Block(nn.Module):
             self.residual = lambda x: x
         else:
             self.residual = nn.Sequential(
-                nn.Conv2d(in_channels, out_channels, 1),
+                nn.Conv2d(in_channels, out_channels, 1, groups=groups),
                 nn.BatchNorm2d(out_channels,affine=affine),
             )
 
-        self.conv = SpatialGraphConv(in_channels, out_channels,  max_graph_distance)
+        self.conv = SpatialGraphConv(in_channels, out_channels,  max_graph_distance, groups=groups)
         self.bn = nn.BatchNorm2d(out_channels,affine=affine)
         self.relu = nn.ReLU(inplace=True)
         #self.A = A
@@ -438,7 +549,7 @@ class Spatial_Basic_Block(nn.Module):
         #print('x.type:{}'.format(x.dtype))
         #x = torch.tensor(x, dtype=torch.float).to('cuda')
         x = self.conv(x, At)
-        x = x.float().to('cuda')
+        x = x.float()
         x = self.bn(x)
         x = self.relu(x + res_block)
 
@@ -446,7 +557,7 @@ class Spatial_Basic_Block(nn.Module):
 
 
 class Temporal_Basic_Block(nn.Module):
-    def __init__(self, channels, temporal_window_size, stride=1, residual=False, affine=True):
+    def __init__(self, channels, temporal_window_size, stride=1, residual=False, affine=True, groups=1):
         super(Temporal_Basic_Block, self).__init__()
 
         padding = ((temporal_window_size - 1) // 2, 0)
@@ -457,11 +568,11 @@ class Temporal_Basic_Block(nn.Module):
             self.residual = lambda x: x
         else:
             self.residual = nn.Sequential(
-                nn.Conv2d(channels, channels, 1, (stride,1)),
+                nn.Conv2d(channels, channels, 1, (stride,1), groups=groups),
                 nn.BatchNorm2d(channels,affine=affine),
             )
 
-        self.conv = nn.Conv2d(channels, channels, (temporal_window_size,1), (stride,1), padding)
+        self.conv = nn.Conv2d(channels, channels, (temporal_window_size,1), (stride,1), padding, groups=groups)
         self.bn = nn.BatchNorm2d(channels,affine=affine)
         self.relu = nn.ReLU(inplace=True)
 
@@ -478,14 +589,16 @@ class Temporal_Basic_Block(nn.Module):
 
 # Thanks to YAN Sijie for the released code on Github (https://github.com/yysijie/st-gcn)
 class SpatialGraphConv(nn.Module):
-    def __init__(self, in_channels, out_channels,max_graph_distance):
+    def __init__(self, in_channels, out_channels,max_graph_distance, groups=1):
         super(SpatialGraphConv, self).__init__()
 
         # spatial class number (distance = 0 for class 0, distance = 1 for class 1, ...)
         self.s_kernel_size = max_graph_distance + 1
+        # independent streams stacked along the channels, each with its own adjacency (groups, K, V, V)
+        self.groups = groups
 
         # weights of different spatial classes
-        self.gcn = nn.Conv2d(in_channels, out_channels*self.s_kernel_size, 1)
+        self.gcn = nn.Conv2d(in_channels, out_channels*self.s_kernel_size, 1, groups=groups)
 
 
     def forward(self, x, At):
@@ -493,12 +606,18 @@ class SpatialGraphConv(nn.Module):
         # numbers in same class have same weight
         x = self.gcn(x)
 
+        # spatial graph convolution
+        A = torch.tensor(At, dtype=torch.float32).to(x.device)
+        if self.groups > 1:
+            n, gkc, t, v = x.size()
+            x = x.view(n, self.groups, self.s_kernel_size, gkc//self.groups//self.s_kernel_size, t, v)
+            x = torch.einsum('ngkctv,gkvw->ngctw', (x, A[:, :self.s_kernel_size])).contiguous()
+            return x.view(n, -1, t, v)
+
         # divide nodes into different classes
         n, kc, t, v = x.size()
         x = x.view(n, self.s_kernel_size, kc//self.s_kernel_size, t, v)
 
-        # spatial graph convolution
-        A = torch.tensor(At, dtype=torch.float32).to('cuda')
         x = torch.einsum('nkctv,kvw->nctw', (x, A[:self.s_kernel_size])).contiguous()   #使用爱因斯坦求和约定来计算多线性表达式（即乘积之和）的方法。
 
         return x
@@ -523,7 +642,7 @@ class Part_Att_bottleneck(nn.Module):
         self.att = Part_Att(out_channels, parts)
         self.edge = nn.Parameter(torch.ones_like(self.AH))
     def forward(self, x, AS):
-        A = torch.tensor(AS, dtype=torch.double).to('cuda')
+        A = torch.tensor(AS, dtype=torch.double).to(x.device)
         return self.att(self.tcn(self.scn(x, A*self.edge), self.residual(x)))
 
 
@@ -547,7 +666,7 @@ class Part_Share_Att_bottleneck(nn.Module):
         self.edge = nn.Parameter(torch.ones_like(A))
 
     def forward(self, x, AS):
-        A = torch.tensor(AS, dtype=torch.double).to('cuda')
+        A = torch.tensor(AS, dtype=torch.double).to(x.device)
         return self.att(self.tcn(self.scn(x, A * self.edge), self.residual(x)))
 
 
@@ -571,7 +690,7 @@ class Part_Conv_Att_bottleneck(nn.Module):
         self.edge = nn.Parameter(torch.ones_like(A))
 
     def forward(self, x, AS):
-        A = torch.tensor(AS, dtype=torch.double).to('cuda')
+        A = torch.tensor(AS, dtype=torch.double).to(x.device)
         return self.att(self.tcn(self.scn(x, A * self.edge), self.residual(x)))
 
 class Channel_Att_bottleneck(nn.Module):
@@ -594,7 +713,7 @@ class Channel_Att_bottleneck(nn.Module):
         self.edge = nn.Parameter(torch.ones_like(A))
 
     def forward(self, x, AS):
-        A = torch.tensor(AS, dtype=torch.double).to('cuda')
+        A = torch.tensor(AS, dtype=torch.double).to(x.device)
         return self.att(self.tcn(self.scn(x, A * self.edge), self.residual(x)))
 
 class Joint_Att_bottleneck(nn.Module):
@@ -617,7 +736,7 @@ class Joint_Att_bottleneck(nn.Module):
         self.edge = nn.Parameter(torch.ones_like(A))
 
     def forward(self, x, AS):
-        A = torch.tensor(AS, dtype=torch.float32).to('cuda')
+        A = torch.tensor(AS, dtype=torch.float32).to(x.device)
         return self.att(self.tcn(self.scn(x, A * self.edge), self.residual(x)))
 
 class Frame_Att_bottleneck(nn.Module):
@@ -640,7 +759,7 @@ class Frame_Att_bottleneck(nn.Module):
         self.edge = nn.Parameter(torch.ones_like(A))
 
     def forward(self, x, AS):
-        A = torch.tensor(AS, dtype=torch.double).to('cuda')
+        A = torch.tensor(AS, dtype=torch.double).to(x.device)
         return self.att(self.tcn(self.scn(x, A * self.edge), self.residual(x)))
 #
 
@@ -663,7 +782,7 @@ class Basic_bottleneck(nn.Module):
         self.edge = nn.Parameter(torch.ones_like(A))
 
     def forward(self, x, AS):
-        A = torch.tensor(AS, dtype=torch.double).to('cuda')
+        A = torch.tensor(AS, dtype=torch.double).to(x.device)
         return self.tcn(self.scn(x, A * self.edge), self.residual(x))
 
 class Basic_net(nn.Module):
@@ -686,5 +805,5 @@ class Basic_net(nn.Module):
         self.edge = nn.Parameter(torch.ones_like(A))
 
     def forward(self, x, AS):
-        A = AS.cuda()
+        A = AS.to(x.device)
         return self.tcn(self.scn(x, A * self.edge), self.residual(x))
\ No newline at end of file
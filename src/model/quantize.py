@@ -0,0 +1,131 @@
+import os
+import sys
+import logging
+import torch
+from torch import nn
+from torch.ao import quantization
+
+import utils
+from freeze import freeze
+from export import load_derived
+from benchmark import time_it
+
+sys.path.append("..")
+from args import helper, args
+
+log_format = '%(asctime)s %(message)s'
+logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                    format=log_format, datefmt='%m/%d %I:%M:%S %p')
+
+QUANTIZABLE = (nn.Conv2d, nn.Linear, nn.ReLU, nn.AdaptiveAvgPool2d)
+
+
+def quantizable(module):
+    # a Conv2d/Linear or a Sequential of convolutions, ReLUs and pooling
+    if isinstance(module, nn.Sequential):
+        return len(module) > 0 and all(isinstance(m, QUANTIZABLE) for m in module)
+    return isinstance(module, (nn.Conv2d, nn.Linear))
+
+
+def fuse_conv_relu(module):
+    # Conv2d -> ReLU pairs of a Sequential become one quantized ConvReLU2d
+    pairs = [[str(i), str(i + 1)] for i in range(len(module) - 1)
+             if isinstance(module[i], nn.Conv2d) and isinstance(module[i + 1], nn.ReLU)]
+    return quantization.fuse_modules(module, pairs) if pairs else module
+
+
+def wrap_quantizable(module, qconfig):
+    """ Wrap every quantizable child of module in a QuantWrapper, in place.
+
+    The graph aggregations (einsum with A * edge), the attention products and
+    the batch norms that follow them stay in float, the wrappers quantize the
+    inputs of the convolutions and the classifier and dequantize their outputs.
+    """
+    for name, child in module.named_children():
+        if quantizable(child):
+            if isinstance(child, nn.Sequential):
+                child = fuse_conv_relu(child)
+            wrapper = quantization.QuantWrapper(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            wrap_quantizable(child, qconfig)
+    return module
+
+
+def prepare_int8(model, backend='x86'):
+    # frozen copy of a DerivedNetwork with observers in front of its quantizable modules
+    torch.backends.quantized.engine = backend
+    frozen = wrap_quantizable(freeze(model).cpu(), quantization.get_default_qconfig(backend))
+    return quantization.prepare(frozen)
+
+
+def calibrate(model, queue, num_batches):
+    with torch.no_grad():
+        for step, (input, target, _) in enumerate(queue):
+            if step >= num_batches:
+                break
+            model(input.float())
+    return model
+
+
+def quantize_int8(model, queue, num_batches, backend='x86'):
+    """ Post-training static int8 quantization of a trained DerivedNetwork.
+
+    Args:
+        model (DerivedNetwork): trained network, it is not modified
+        queue (DataLoader): calibration batches, e.g. valid_queue
+        num_batches (int): number of calibration batches
+        backend (str): torch.backends.quantized engine
+
+    Returns:
+        quantized freeze.FrozenNetwork, on CPU
+    """
+    prepared = calibrate(prepare_int8(model, backend), queue, num_batches)
+    return quantization.convert(prepared)
+
+
+def evaluate(model, queue):
+    # logits and targets of queue
+    logits, targets = [], []
+    with torch.no_grad():
+        for input, target, _ in queue:
+            logits.append(model(input.float()))
+            targets.append(target.long())
+    return torch.cat(logits, 0), torch.cat(targets, 0)
+
+
+def main():
+    """ Quantize the network written by derive.py for --checkpoint_epoch and
+    compare it with the float network on valid_queue.
+    """
+    filename = os.path.join(args.save, 'derived_{}_{}'.format(args.task_id, args.checkpoint_epoch))
+    _, valid_queue, data_shape, _, A, _ = helper.get_train_val_loaders()
+    model = load_derived(filename + '.pth.tar', torch.from_numpy(A))
+    int8 = quantize_int8(model, valid_queue, args.calib_batches, args.quant_backend)
+
+    float_logits, target = evaluate(model, valid_queue)
+    int8_logits, _ = evaluate(int8, valid_queue)
+    float_acc = utils.accuracy(float_logits, target)[0].item()
+    int8_acc = utils.accuracy(int8_logits, target)[0].item()
+    logging.info('top-1 acc float %f int8 %f delta %f', float_acc, int8_acc, int8_acc - float_acc)
+    float_class = utils.action_accuracy(float_logits, target)
+    int8_class = utils.action_accuracy(int8_logits, target)
+    for name, f, q in zip(utils.ACTION_NAMES, float_class, int8_class):
+        logging.info('%6s float %.4f int8 %.4f delta %+.4f', name, f, q, q - f)
+
+    input = next(iter(valid_queue))[0].float()
+    with torch.no_grad():
+        t_float = time_it(lambda: model(input), args.bench_repeats)
+        t_int8 = time_it(lambda: int8(input), args.bench_repeats)
+    size_float, size_int8 = utils.state_dict_size_in_MB(model), utils.state_dict_size_in_MB(int8)
+    logging.info('batch size %d latency float %.4fs int8 %.4fs speedup %.2f', input.size(0), t_float, t_int8,
+                 t_float / t_int8)
+    logging.info('size float %.3fMB int8 %.3fMB reduction %.2f', size_float, size_int8, size_float / size_int8)
+
+    torch.jit.save(torch.jit.script(int8), filename + '_int8.pt')
+    logging.info('saved %s_int8.pt', filename)
+
+
+if __name__ == '__main__':
+    main()
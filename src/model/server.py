@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+
+from utils import ACTION_NAMES
+from freeze import freeze
+from export import load_derived
+from stream import keypoints_to_frame
+
+sys.path.append("..")
+from dataset.feeder import multi_input
+from dataset.graph import Graph
+from args import helper, args
+
+log_format = '%(asctime)s %(message)s'
+logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                    format=log_format, datefmt='%m/%d %I:%M:%S %p')
+
+
+class DynamicBatcher(object):
+    """ Gathers concurrent requests into batches for one model.
+
+    A batch is only formed when one of the workers threads is free, so the
+    requests that arrive while all workers are busy queue up for the next
+    batch. It is closed when it has max_batch samples or when its first sample
+    has waited max_delay seconds.
+
+    Args:
+        model (nn.Module): network taking (N, I, C, T, V, M) inputs
+        max_batch (int): samples per forward pass
+        max_delay (float): seconds the first sample of a batch waits for more
+        workers (int): batches run concurrently
+        history (int): latencies kept for the percentiles
+    """
+    def __init__(self, model, max_batch=32, max_delay=0.01, workers=2, history=1000):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.free_workers = threading.Semaphore(workers)
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.served = 0
+        self.running = True
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, data):
+        # (I, C, T, V, M) sample, returns a Future of its softmax scores
+        future = Future()
+        with self.cond:
+            self.queue.append((data, time.time(), future))
+            self.cond.notify()
+        return future
+
+    def _dispatch(self):
+        while True:
+            self.free_workers.acquire()
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                deadline = self.queue[0][1] + self.max_delay
+                while len(self.queue) < self.max_batch and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+                batch = [self.queue.popleft() for _ in range(min(self.max_batch, len(self.queue)))]
+            self.pool.submit(self._run, batch)
+
+    def _run(self, batch):
+        try:
+            input = torch.from_numpy(np.stack([data for data, _, _ in batch])).float()
+            with torch.no_grad():
+                scores = torch.softmax(self.model(input), dim=1).numpy()
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            self.free_workers.release()
+        done = time.time()
+        with self.cond:
+            self.batch_sizes.append(len(batch))
+            self.served += len(batch)
+            for _, arrival, _ in batch:
+                self.latencies.append(done - arrival)
+        for (_, _, future), s in zip(batch, scores):
+            future.set_result(s)
+
+    def stats(self):
+        with self.cond:
+            latencies = np.array(self.latencies) * 1000
+            stats = {'queue_depth': len(self.queue),
+                     'served': self.served,
+                     'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0}
+        for p in [50, 95, 99]:
+            stats['p{}_ms'.format(p)] = float(np.percentile(latencies, p)) if len(latencies) else 0.0
+        return stats
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.dispatcher.join()
+        self.pool.shutdown()
+
+
+def sample_from_request(request, connect_joint, data_shape):
+    """ (I, C, T, V, M) input of a request, built like Preprocess_Feeder.
+
+    The request has either "data", the (C, T, V) or (C, T, V, M) frames of the
+    training data, or "keypoints", one DeepLabCut keypoint list (x, y, score
+    per joint) per frame, null for frames without a detection. Sequences
+    shorter than T are zero padded at the end, as in Feeder_animal.
+    """
+    I, C, T, V, M = data_shape
+    if not isinstance(request, dict):
+        raise ValueError('the request must be a JSON object')
+    if 'data' in request:
+        data = np.asarray(request['data'], dtype=np.float32)
+        if data.ndim not in (3, 4):
+            raise ValueError('"data" must have 3 or 4 dimensions, got {}'.format(data.ndim))
+        if data.ndim == 3:
+            data = data[..., None]
+    elif 'keypoints' in request:
+        keypoints = request['keypoints']
+        if not isinstance(keypoints, list) or not keypoints:
+            raise ValueError('"keypoints" must be a non-empty list of frames')
+        data = np.stack([keypoints_to_frame(k, V) for k in keypoints], axis=1)[..., None]
+    else:
+        raise ValueError('the request needs "data" or "keypoints"')
+    if data.shape[0] != C or data.shape[2] != V or data.shape[3] != M or data.shape[1] > T:
+        raise ValueError('expected at most {} frames of shape {}, got {}'.format(T, (C, V, M), data.shape))
+    padded = np.zeros((C, T, V, M), dtype=np.float32)
+    padded[:, :data.shape[1]] = data
+    return multi_input(padded, connect_joint)
+
+
+def make_handler(batcher, connect_joint, data_shape, timeout=30.0):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, batcher.stats())
+            elif self.path == '/health':
+                self._reply(200, {'status': 'ok'})
+            else:
+                self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+                return
+            start = time.time()
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                sample = sample_from_request(request, connect_joint, data_shape)
+            except (ValueError, TypeError, IndexError) as e:
+                # malformed JSON, non-numeric arrays or keypoint lists of the wrong length
+                self._reply(400, {'error': str(e)})
+                return
+            try:
+                scores = batcher.submit(sample).result(timeout)
+            except FutureTimeoutError:
+                self._reply(504, {'error': 'no prediction within {}s'.format(timeout)})
+                return
+            except Exception as e:
+                self._reply(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+                return
+            self._reply(200, {'label': ACTION_NAMES[int(scores.argmax())],
+                              'scores': dict(zip(ACTION_NAMES, scores.tolist())),
+                              'latency_ms': (time.time() - start) * 1000})
+
+        def log_message(self, format, *log_args):
+            # one line per request would flood the log
+            pass
+
+    return Handler
+
+
+def serve(model, connect_joint, data_shape, host='127.0.0.1', port=8000, max_batch=32, max_delay=0.01, workers=2,
+          timeout=30.0):
+    """ Start the HTTP server of model in a background thread.
+
+    Endpoints: POST /predict (see sample_from_request), GET /stats (queue
+    depth, latency percentiles, mean batch size) and GET /health. A malformed
+    request gets 400, a prediction that takes more than timeout seconds 504
+    and an error of the model 500, all with a JSON "error".
+
+    Returns:
+        server (ThreadingHTTPServer) and batcher (DynamicBatcher), stop them
+        with server.shutdown() and batcher.close()
+    """
+    batcher = DynamicBatcher(model, max_batch=max_batch, max_delay=max_delay, workers=workers)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, connect_joint, data_shape, timeout))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, batcher
+
+
+def main():
+    """ Serve the network written by derive.py for --checkpoint_epoch. """
+    filename = os.path.join(args.save, 'derived_{}_{}.pth.tar'.format(args.task_id, args.checkpoint_epoch))
+    _, _, data_shape, _, A, _ = helper.get_train_val_loaders()
+    model = freeze(load_derived(filename, torch.from_numpy(A)))
+    server, batcher = serve(model, Graph(args.dataset).connect_joint, data_shape, args.server_host, args.server_port,
+                            args.max_batch, args.max_delay_ms / 1000, args.server_workers)
+    logging.info('serving %s on http://%s:%d', filename, args.server_host, args.server_port)
+    try:
+        while True:
+            time.sleep(60)
+            logging.info('stats %s', batcher.stats())
+    except KeyboardInterrupt:
+        server.shutdown()
+        batcher.close()
+
+
+if __name__ == '__main__':
+    main()
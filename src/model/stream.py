@@ -0,0 +1,121 @@
+import sys
+import time
+from collections import namedtuple
+import numpy as np
+import torch
+
+from utils import ACTION_NAMES
+
+sys.path.append("..")
+from dataset.deeplabcut import normalize_keypoints
+from dataset.feeder import multi_input
+
+Prediction = namedtuple('Prediction', 'stream frame label scores latency')
+
+
+def keypoints_to_frame(keypoints, num_joints):
+    """ (C, V) frame of one DeepLabCut skeleton, normalized like json_pack and
+    centralized like Feeder_animal. None, e.g. no animal detected, gives the
+    zero frame the feeders use for missing frames.
+    """
+    frame = np.zeros((3, num_joints), dtype=np.float32)
+    if keypoints is None:
+        return frame
+    coordinates, score = normalize_keypoints(list(keypoints))
+    frame[0] = coordinates[0::2]
+    frame[1] = coordinates[1::2]
+    frame[2] = score
+    frame[0:2] -= 0.5
+    frame[0:2, frame[2] == 0] = 0
+    return frame
+
+
+class FrameRing(object):
+    # last `window` frames of one stream
+    def __init__(self, window, num_joints, channels=3):
+        self.window = window
+        self.data = np.zeros((channels, window, num_joints), dtype=np.float32)
+        self.count = 0
+
+    def push(self, frame):
+        self.data[:, self.count % self.window] = frame
+        self.count += 1
+
+    def full(self):
+        return self.count >= self.window
+
+    def frames(self):
+        # (C, T, V), oldest frame first
+        return np.roll(self.data, -(self.count % self.window), axis=1)
+
+
+class StreamingRecognizer(object):
+    """ Sliding-window behaviour recognition over many pose streams (cameras
+    or animals).
+
+    Every stream keeps a ring buffer of its last `window` frames. Once the
+    buffer is full, a window is queued every `stride` frames, and flush()
+    classifies all queued windows of all streams in batches of at most
+    `max_batch`.
+
+    Args:
+        model (nn.Module): DerivedNetwork, freeze.FrozenNetwork, or a scripted
+            or quantized network, taking (N, I, C, T, V, M) inputs
+        connect_joint (array): parent joint of every joint, Graph.connect_joint
+        window (int): frames per window, T of the training data
+        stride (int): frames between two predictions of a stream
+        max_batch (int): windows per forward pass
+        num_joints (int): joints per skeleton
+        device (str): device of the model
+    """
+    def __init__(self, model, connect_joint, window=40, stride=10, max_batch=64, num_joints=18, device='cpu'):
+        self.model = model
+        self.conn = connect_joint
+        self.window = window
+        self.stride = stride
+        self.max_batch = max_batch
+        self.num_joints = num_joints
+        self.device = device
+        self.rings = {}
+        self.pending = []
+
+    def push(self, stream, keypoints, arrival=None):
+        """ Add the next frame of stream. arrival is the time the frame was
+        received (time.time()), the latency of a window is measured from the
+        arrival of its last frame.
+        """
+        arrival = time.time() if arrival is None else arrival
+        ring = self.rings.get(stream)
+        if ring is None:
+            ring = self.rings[stream] = FrameRing(self.window, self.num_joints)
+        ring.push(keypoints_to_frame(keypoints, self.num_joints))
+        if ring.full() and (ring.count - self.window) % self.stride == 0:
+            data = multi_input(ring.frames()[:, :, :, None], self.conn)
+            self.pending.append((stream, ring.count - 1, arrival, data))
+
+    def flush(self):
+        # predictions of all queued windows, in the order they were queued
+        predictions = []
+        while self.pending:
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            input = torch.from_numpy(np.stack([data for _, _, _, data in batch])).float().to(self.device)
+            with torch.no_grad():
+                scores = torch.softmax(self.model(input), dim=1).cpu().numpy()
+            done = time.time()
+            for (stream, frame, arrival, _), s in zip(batch, scores):
+                predictions.append(Prediction(stream, frame, ACTION_NAMES[int(s.argmax())], s, done - arrival))
+        return predictions
+
+    def step(self, frames):
+        """ Push one frame per stream, e.g. the frames of all cameras received
+        since the last step, and classify the windows they complete.
+
+        Args:
+            frames (iterable): (stream, keypoints) pairs
+
+        Returns:
+            list of Prediction
+        """
+        for stream, keypoints in frames:
+            self.push(stream, keypoints)
+        return self.flush()
@@ -0,0 +1,197 @@
+import os
+import sys
+import csv
+import time
+import logging
+import numpy as np
+import torch
+
+from utils import ACTION_NAMES
+from freeze import freeze
+from export import load_derived
+from stream import keypoints_to_frame
+
+sys.path.append("..")
+from dataset.deeplabcut import iter_keypoints
+from dataset.feeder import multi_input
+from dataset.graph import Graph
+from args import helper, args
+
+log_format = '%(asctime)s %(message)s'
+logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                    format=log_format, datefmt='%m/%d %I:%M:%S %p')
+
+
+def json_chunks(snippets_dir, num_joints, chunk_size):
+    """ (C, t, V) chunks of normalized frames of a directory of DeepLabCut json
+    files. Missing frame indices give zero frames, as in Feeder_animal.
+    """
+    chunk, expected = [], 0
+    for frame_index, keypoints in iter_keypoints(snippets_dir):
+        for _ in range(expected, frame_index):
+            chunk.append(keypoints_to_frame(None, num_joints))
+        chunk.append(keypoints_to_frame(keypoints, num_joints))
+        expected = frame_index + 1
+        if len(chunk) >= chunk_size:
+            yield np.stack(chunk, axis=1)
+            chunk = []
+    if chunk:
+        yield np.stack(chunk, axis=1)
+
+
+def npy_chunks(path, chunk_size):
+    # (C, t, V) chunks of a (C, T, V) or (C, T, V, 1) array, read with mmap
+    data = np.load(path, mmap_mode='r')
+    for start in range(0, data.shape[1], chunk_size):
+        chunk = np.asarray(data[:, start:start + chunk_size], dtype=np.float32)
+        yield chunk[..., 0] if chunk.ndim == 4 else chunk
+
+
+def windows(chunks, window, stride, connect_joint):
+    """ (start, (I, C, T, V, M) input) of the windows of a recording, every
+    stride frames, built like dataset.feeder.multi_input. Only the last
+    window frames are kept between chunks. A recording shorter than window,
+    or with frames after the last window, ends with a window over its last
+    frames, zero padded if needed.
+
+    Yields:
+        start frame of the window and its input
+    """
+    buffer, offset, next_start, n = None, 0, 0, len(connect_joint)
+    for chunk in chunks:
+        buffer = chunk if buffer is None else np.concatenate([buffer, chunk], axis=1)
+        C, L, V = buffer.shape
+        if next_start + window > offset + L:
+            continue
+        # bone and motion of the whole buffer, the motion of the last frame of every window is zeroed below
+        bone = np.zeros_like(buffer)
+        bone[:, :, :n] = buffer[:, :, :n] - buffer[:, :, connect_joint]
+        motion = np.zeros_like(buffer)
+        motion[:, :-1] = buffer[:, 1:] - buffer[:, :-1]
+        while next_start + window <= offset + L:
+            s = next_start - offset
+            x = np.stack([buffer[:, s:s + window], bone[:, s:s + window], motion[:, s:s + window]])
+            x[2, :, -1] = 0
+            yield next_start, x[..., None]
+            next_start += stride
+        keep = min(offset + L - window, next_start)
+        buffer = buffer[:, keep - offset:]
+        offset = keep
+    if buffer is None:
+        return
+    end = offset + buffer.shape[1]
+    if next_start - stride + window < end or end < window:
+        start = max(end - window, 0)
+        last = np.zeros((buffer.shape[0], window, buffer.shape[2], 1), dtype=np.float32)
+        last[:, :end - start, :, 0] = buffer[:, start - offset:]
+        yield start, multi_input(last, connect_joint).astype(np.float32)
+
+
+class TimelineWriter(object):
+    """ Per-frame labels from overlapping window predictions. The scores of a
+    frame are the mean softmax scores of the windows that contain it. A frame
+    is written once no later window can contain it, so only the frames of the
+    windows in flight are kept.
+    """
+    def __init__(self, file, window):
+        self.writer = csv.writer(file)
+        self.writer.writerow(['frame', 'label'] + ['score_{}'.format(name) for name in ACTION_NAMES])
+        self.window = window
+        self.scores = np.zeros((0, len(ACTION_NAMES)))
+        self.counts = np.zeros(0)
+        self.offset = 0
+        self.frames = 0
+
+    def add(self, start, scores):
+        # windows must come in the order of their start frame
+        end = start + self.window
+        if end - self.offset > len(self.counts):
+            grow = end - self.offset - len(self.counts)
+            self.scores = np.concatenate([self.scores, np.zeros((grow, self.scores.shape[1]))])
+            self.counts = np.concatenate([self.counts, np.zeros(grow)])
+        self.scores[start - self.offset:end - self.offset] += scores
+        self.counts[start - self.offset:end - self.offset] += 1
+        self.flush(start)
+
+    def flush(self, until):
+        # write the frames before until
+        n = min(until - self.offset, len(self.counts))
+        for i in range(max(n, 0)):
+            s = self.scores[i] / max(self.counts[i], 1)
+            self.writer.writerow([self.offset + i, ACTION_NAMES[int(s.argmax())]] + ['%.4f' % v for v in s])
+        if n > 0:
+            self.scores, self.counts = self.scores[n:], self.counts[n:]
+            self.offset += n
+            self.frames += n
+
+
+def label_recording(model, chunks, file, window, stride, connect_joint, batch_size=256):
+    """ Write the per-frame timeline of a recording to file as CSV.
+
+    Args:
+        model (nn.Module): network taking (N, I, C, T, V, M) inputs
+        chunks (iterable): (C, t, V) frame chunks, see json_chunks and npy_chunks
+        file: text file the CSV is written to
+        window (int): frames per window, T of the training data
+        stride (int): frames between two windows
+        connect_joint (array): parent joint of every joint, Graph.connect_joint
+        batch_size (int): windows per forward pass
+
+    Returns:
+        number of frames and windows
+    """
+    timeline = TimelineWriter(file, window)
+    batch, starts, num_windows = [], [], 0
+    num_frames = [0]
+
+    def counted(chunks):
+        # the padded frames of a last window shorter than the recording are not written
+        for chunk in chunks:
+            num_frames[0] += chunk.shape[1]
+            yield chunk
+
+    def run():
+        with torch.no_grad():
+            scores = torch.softmax(model(torch.from_numpy(np.stack(batch)).float()), dim=1).numpy()
+        for start, s in zip(starts, scores):
+            timeline.add(start, s)
+
+    for start, x in windows(counted(chunks), window, stride, connect_joint):
+        batch.append(x)
+        starts.append(start)
+        num_windows += 1
+        if len(batch) == batch_size:
+            run()
+            batch, starts = [], []
+    if batch:
+        run()
+    timeline.flush(num_frames[0])
+    return timeline.frames, num_windows
+
+
+def main():
+    """ Label --recording, a directory of DeepLabCut json files or a .npy array,
+    with the network written by derive.py for --checkpoint_epoch.
+    """
+    filename = os.path.join(args.save, 'derived_{}_{}.pth.tar'.format(args.task_id, args.checkpoint_epoch))
+    _, _, data_shape, _, A, _ = helper.get_train_val_loaders()
+    model = freeze(load_derived(filename, torch.from_numpy(A)))
+    I, C, T, V, M = data_shape
+    connect_joint = Graph(args.dataset).connect_joint
+    chunk_size = max(args.timeline_batch * args.stream_stride, T)
+    if os.path.isdir(args.recording):
+        chunks = json_chunks(args.recording, V, chunk_size)
+    else:
+        chunks = npy_chunks(args.recording, chunk_size)
+
+    start = time.time()
+    with open(args.timeline_csv, 'w', newline='') as f:
+        frames, num_windows = label_recording(model, chunks, f, T, args.stream_stride, connect_joint,
+                                              args.timeline_batch)
+    elapsed = time.time() - start
+    logging.info('%d frames, %d windows in %.1fs, %.1f frames/s, written to %s', frames, num_windows, elapsed,
+                 frames / elapsed, args.timeline_csv)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 import glob
 import numpy as np
 import torch
@@ -13,7 +14,6 @@ import torch.utils
 import torch.nn.functional as F
 import torchvision.datasets as dset
 import torch.backends.cudnn as cudnn
-from copy import deepcopy
 from numpy import linalg as LA
 from torch.autograd import Variable
 from torch.optim.lr_scheduler import CosineAnnealingLR
@@ -25,7 +25,7 @@ import utils
 from space import spaces_dict
 from model_search import Network
 from architect import Architect
-from analyze import Analyzer
+from analyze import Analyzer, BackgroundAnalyzer, analyse
 
 import sys
 sys.path.append("..")
@@ -67,6 +67,30 @@ def main(primitives):
         model_init = model_init.cuda()
     logging.info("param size = %fMB", utils.count_parameters_in_MB(model_init))
 
+    if args.stem_weights:
+        stem_state = torch.load(args.stem_weights, map_location='cpu')
+        stem_state = stem_state.get('state_dict', stem_state)
+        stem_state = {k[len('stem.'):]: v for k, v in stem_state.items() if k.startswith('stem.')} or stem_state
+        model_init.stem.load_state_dict(stem_state)
+        logging.info('loaded stem weights from %s', args.stem_weights)
+
+    # the same training and validation samples for the Hessian of every epoch
+    probe = None
+    if args.compute_hessian:
+        device = 'cpu' if args.disable_cuda else 'cuda'
+        probe_size = args.probe_size or args.batch_size
+        probe = (utils.probe_batch(train_queue.dataset, probe_size, args.seed, device),
+                 utils.probe_batch(valid_queue.dataset, probe_size, args.seed + 1, device))
+    background = None
+    if args.compute_hessian and args.async_hessian and not args.debug:
+        background = BackgroundAnalyzer(args, args.analysis_lag)
+
+    stem_cache = None
+    if args.stem_cache != 'none':
+        stem_cache = utils.StemFeatureCache(args.stem_cache,
+                                            len(train_queue.dataset) + len(valid_queue.dataset),
+                                            os.path.join(args.save, 'stem_features.npy'))
+
     optimizer_init = torch.optim.SGD(
         model_init.parameters(),
         args.learning_rate,
@@ -93,7 +117,8 @@ def main(primitives):
                      architect=architect_init, criterion=criterion,
                      primitives=primitives, analyser=analyser_init,
                      la_tracker=la_tracker,
-                     errors_dict=errors_dict, start_epoch=-1):
+                     errors_dict=errors_dict, stem_cache=stem_cache, probe=probe, background=background,
+                     start_epoch=-1):
 
         logging.info('STARTING ITERATION: %d', iteration)
         logging.info('EPOCHS TO TRAIN: %d', epochs_to_train - start_epoch - 1)
@@ -107,9 +132,30 @@ def main(primitives):
         train_losss = []
         valid_losss = []
         epochh = []
+        prune_epochs = [int(e) for e in args.prune_epochs.split(',') if e]
         for epoch in range(start_epoch + 1, epochs_to_train):
+            epoch_start = time.time()
+            if not args.disable_cuda:
+                torch.cuda.reset_peak_memory_stats()
             # set the epoch to the right one
             # epoch += args.epochs - epochs_to_train
+            if epoch in prune_epochs or (args.prune_threshold > 0 and not prune_epochs):
+                old_arch_parameters = model.arch_parameters()
+                num_ops = len(model.PRIMITIVES['primitives_normal'][0])
+                keep = model.prune(args.prune_num if epoch in prune_epochs else 0, args.prune_threshold)
+                if keep is not None:
+                    utils.prune_optimizer_states(model, optimizer, architect.optimizer, old_arch_parameters, keep)
+                    logging.info('primitives = %s', model.PRIMITIVES['primitives_normal'][:len(keep)])
+                logging.info('epoch %d pruned %d candidates per edge, %d left, param size = %fMB', epoch,
+                             num_ops - len(model.PRIMITIVES['primitives_normal'][0]),
+                             len(model.PRIMITIVES['primitives_normal'][0]), utils.count_parameters_in_MB(model))
+
+            if (args.stem_weights or 0 <= args.freeze_stem_epoch <= epoch) and not model.stem_frozen:
+                model.freeze_stem()
+                if stem_cache is not None:
+                    stem_cache.reset()
+                logging.info('epoch %d stem frozen, param size = %fMB', epoch, utils.count_parameters_in_MB(model))
+
             beta_decay_scheduler.step(epoch)
             logging.info("EPOCH %d SKIP BETA DECAY RATE: %e", epoch, beta_decay_scheduler.decay_rate)
             scheduler.step(epoch)
@@ -120,17 +166,23 @@ def main(primitives):
                              model.drop_path_prob)
             else:
                 logging.info('epoch %d lr %e', epoch, lr)
+            if args.sample_ops > 0:
+                model.tau = args.tau_max - (args.tau_max - args.tau_min) * epoch / max(args.epochs - 1, 1)
+                logging.info('epoch %d tau %e', epoch, model.tau)
 
             # training
             train_acc, train_obj = train(epoch, primitives, train_queue,
                                          valid_queue, model, architect, criterion,
                                          optimizer, lr, analyser, la_tracker,
-                                         iteration)
+                                         iteration, stem_cache, probe, background)
             logging.info('train_acc_mean %f', train_acc)
             logging.info('train_loss %f', train_obj)
+            logging.info('epoch %d peak memory %fMB (grad_checkpoint %s, %s)', epoch,
+                         utils.peak_memory_in_MB(args.disable_cuda), args.grad_checkpoint,
+                         utils.peak_memory_scope(args.disable_cuda))
 
             # validation
-            valid_acc, valid_obj, logitt, targett = infer(valid_queue, model, criterion)
+            valid_acc, valid_obj, logitt, targett = infer(valid_queue, model, criterion, stem_cache)
             logging.info('valid_acc_mean %f', valid_acc)
             logging.info('valid_loss %f', valid_obj)
 
@@ -154,6 +206,9 @@ def main(primitives):
                      'optimizer': optimizer.state_dict(),
                      'alphas_normal': model.alphas_normal.data,
                      'alphas_reduce': model.alphas_reduce.data,
+                     'primitives': model.PRIMITIVES,
+                     'betas_normal': model.betas_normal.data if args.partial_channel > 1 else None,
+                     'betas_reduce': model.betas_reduce.data if args.partial_channel > 1 else None,
                      'arch_optimizer': architect.optimizer.state_dict(),
                      'lr': lr,
                      'ev': la_tracker.ev,
@@ -166,8 +221,10 @@ def main(primitives):
                      }
 
             utils.save_checkpoint(state, False, args.save, epoch, args.task_id)
+            logging.info('epoch %d time %fs', epoch, time.time() - epoch_start)
 
-            if not args.compute_hessian:
+            if not args.compute_hessian or not la_tracker.ev:
+                # with --async_hessian the first eigenvalues can still be pending
                 ev = -1
             else:
                 ev = la_tracker.ev[-1]
@@ -278,6 +335,10 @@ def main(primitives):
 
                     analyser_new = Analyzer(args, model_new)
 
+                    if background is not None:
+                        # eigenvalues of epochs after the rollback are not used
+                        background.collect(0)
+
                     la_tracker = utils.EVLocalAvg(args.window, args.report_freq_hessian,
                                                   args.epochs)
 
@@ -322,6 +383,8 @@ def main(primitives):
     # call train_epochs recursively
     best_state = {'acc_top1': 0, 'genotype': None, 'logits_best': None, 'target_best': None, 'model_best': None}
     genotype, valid_acc = train_epochs(args.epochs, 1)
+    if background is not None:
+        background.close()
     logging.info('Best top-1 acc:%f,genotype:%s', best_state['acc_top1'], best_state['genotype'])
     utils.confusionmatrix(best_state['logits_best'], best_state['target_best'])
     utils.show_action_accuracy(best_state['logits_best'], best_state['target_best'])
@@ -347,19 +410,22 @@ def main(primitives):
 
 
 def train(epoch, primitives, train_queue, valid_queue, model, architect,
-          criterion, optimizer, lr, analyser, local_avg_tracker, iteration=1):
+          criterion, optimizer, lr, analyser, local_avg_tracker, iteration=1, stem_cache=None, probe=None,
+          background=None):
     objs = utils.AverageMeter()
     top1 = utils.AverageMeter()
     top5 = utils.AverageMeter()
 
     def valid_generator():
         while True:
-            for x, t, _ in valid_queue:
-                yield x, t
+            for x, t, y in valid_queue:
+                yield x, t, y
 
     valid_gen = valid_generator()
+    # with a frozen stem the cells are fed the cached stem features
+    use_cache = stem_cache is not None and model.stem_frozen
 
-    for step, (input, target, _) in enumerate(train_queue):
+    for step, (input, target, names) in enumerate(train_queue):
         model.train()
         n = input.size(0)
 
@@ -369,15 +435,19 @@ def train(epoch, primitives, train_queue, valid_queue, model, architect,
         if not args.disable_cuda:
             input = input.cuda()
             target = target.cuda()
+        if use_cache:
+            input = stem_cache(model, input, names)
 
         if architect is not None:
             # get a random minibatch from the search queue with replacement
-            input_search, target_search = next(valid_gen)  # next(iter(valid_queue))
+            input_search, target_search, names_search = next(valid_gen)  # next(iter(valid_queue))
             input_search = Variable(input_search, requires_grad=False)
             target_search = Variable(target_search, requires_grad=False)
             if not args.disable_cuda:
                 input_search = input_search.cuda()
                 target_search = target_search.cuda()
+            if use_cache:
+                input_search = stem_cache(model, input_search, names_search)
 
             architect.step(input, target, input_search, target_search, lr, optimizer, unrolled=args.unrolled)
 
@@ -396,54 +466,37 @@ def train(epoch, primitives, train_queue, valid_queue, model, architect,
 
     if args.compute_hessian:
         if (epoch % args.report_freq_hessian == 0) or (epoch == (args.epochs - 1)):
-            _data_loader = deepcopy(train_queue)
-            input, target, _ = next(iter(_data_loader))
-
-            input = Variable(input, requires_grad=False)
-            target = Variable(target, requires_grad=False)
-            if not args.disable_cuda:
-                input = input.cuda()
-                target = target.cuda()
-
-            if not args.debug:
-                H = analyser.compute_Hw(input, target, input_search, target_search,
-                                        lr, optimizer, False)
-                g = analyser.compute_dw(input, target, input_search, target_search,
-                                        lr, optimizer, False)
-                g = torch.cat([x.view(-1) for x in g])
-
-                del _data_loader
-
-                state = {'epoch': epoch,
-                         'H': H.cpu().data.numpy().tolist(),
-                         'g': g.cpu().data.numpy().tolist(),
-                         # 'g_train': float(grad_norm),
-                         # 'eig_train': eigenvalue,
-                         }
-
-                with codecs.open(os.path.join(args.save,
-                                              'derivatives_{}.json'.format(args.task_id)),
-                                 'a', encoding='utf-8') as file:
-                    json.dump(state, file, separators=(',', ':'))
-                    file.write('\n')
-
-                # early stopping
-                ev = max(LA.eigvals(H.cpu().data.numpy()))
-            else:
+            if args.debug:
                 ev = 0.1
                 if epoch >= 8 and iteration == 1:
                     ev = 2.0
-            logging.info('CURRENT EV: %f', ev)
-            local_avg_tracker.update(epoch, ev, model.genotype())
-
-            if args.early_stop and epoch != (args.epochs - 1):
-                local_avg_tracker.early_stop(epoch, args.factor, args.es_start_epoch,
-                                             args.delta)
+                results = [(epoch, ev, None, model.genotype())]
+            elif background is not None:
+                background.submit(epoch, model, probe, model.genotype())
+                # the last epoch waits for all pending eigenvalues
+                results = background.collect(0 if epoch == args.epochs - 1 else None)
+            else:
+                ev, state = analyse(analyser, probe, epoch, args.ev_method, args.ev_iters, args.ev_tol)
+                results = [(epoch, ev, state, model.genotype())]
+
+            for ev_epoch, ev, state, genotype in results:
+                if state is not None:
+                    with codecs.open(os.path.join(args.save,
+                                                  'derivatives_{}.json'.format(args.task_id)),
+                                     'a', encoding='utf-8') as file:
+                        json.dump(state, file, separators=(',', ':'))
+                        file.write('\n')
+                logging.info('CURRENT EV: %f (epoch %d)', ev, ev_epoch)
+                local_avg_tracker.update(ev_epoch, ev, genotype)
+
+                if args.early_stop and ev_epoch != (args.epochs - 1):
+                    local_avg_tracker.early_stop(ev_epoch, args.factor, args.es_start_epoch,
+                                                 args.delta)
 
     return top1.avg, objs.avg
 
 
-def infer(valid_queue, model, criterion):
+def infer(valid_queue, model, criterion, stem_cache=None):
     objs = utils.AverageMeter()
     top1 = utils.AverageMeter()
     top5 = utils.AverageMeter()
@@ -456,19 +509,24 @@ def infer(valid_queue, model, criterion):
             yield x, t, y
 
     valid_gen = valid_generator()
-    logit = torch.tensor([], dtype=torch.float).cuda()
-    targett = torch.tensor([], dtype=torch.float).cuda()
+    logit = torch.tensor([], dtype=torch.float)
+    targett = torch.tensor([], dtype=torch.float)
+    if not args.disable_cuda:
+        logit = logit.cuda()
+        targett = targett.cuda()
     for step, (input, target, y) in enumerate(valid_gen):  # valid_queue
         input = Variable(input, volatile=True)
         target = Variable(target, volatile=True)
         if not args.disable_cuda:
             input = input.cuda()
             target = target.cuda()
+        if stem_cache is not None and model.stem_frozen:
+            input = stem_cache(model, input, y)
 
         logits = model(input)
         loss = criterion(logits, target.long())
         prec1, prec5 = utils.accuracy(logits, target.long(), topk=(1, 5))
-        n = input.size(0)
+        n = target.size(0)
 
         objs.update(loss.item(), n)
         top1.update(prec1.item(), n)
@@ -1,3 +1,4 @@
+import io
 import os
 import functools
 import yaml
@@ -334,14 +335,21 @@ def confusionmatrix(output, target, topk=(1,5)):
   plt.savefig('confusion_1.png')
 
 
-def show_action_accuracy(output,target,topk=(1,5)):
-  names = ['lie','run','sit','stand','walk']
+ACTION_NAMES = ['lie','run','sit','stand','walk']
+
+def action_accuracy(output,target,topk=(1,5)):
+  # per class precision of the top-1 predictions, in the order of ACTION_NAMES
   mink = min(topk)
-  sns.set()
-  f, ax = plt.subplots()
   _, pred = output.topk(mink, 1, True, True)
   pred = pred.t()
-  accuracy=precision_score(target.cpu(),pred.cpu().view(target.shape), average=None)
+  return precision_score(target.cpu(),pred.cpu().view(target.shape), average=None,
+                         labels=list(range(len(ACTION_NAMES))), zero_division=0)
+
+def show_action_accuracy(output,target,topk=(1,5)):
+  names = ACTION_NAMES
+  sns.set()
+  f, ax = plt.subplots()
+  accuracy=action_accuracy(output,target,topk)
   plt.figure()
   plt.bar(names, accuracy, align='center')
   for x,y in zip(names,accuracy):
@@ -484,7 +492,95 @@ def _data_transforms_svhn(args):
   return train_transform, valid_transform
 
 def count_parameters_in_MB(model):
-  return np.sum(np.prod(v.size()) for name, v in model.named_parameters() if "auxiliary" not in name)/1e6
+  return np.sum([np.prod(v.size()) for name, v in model.named_parameters() if "auxiliary" not in name])/1e6
+
+
+def state_dict_size_in_MB(model):
+  # serialized size, counts packed int8 weights that named_parameters() does not list
+  buffer = io.BytesIO()
+  torch.save(model.state_dict(), buffer)
+  return buffer.tell()/1e6
+
+
+def peak_memory_in_MB(disable_cuda):
+  # on cpu this is the peak resident size of the whole process, it is never reset, see peak_memory_scope
+  if not disable_cuda:
+    return torch.cuda.max_memory_allocated()/1e6
+  try:
+    import resource
+  except ImportError:
+    return -1
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3
+
+
+def peak_memory_scope(disable_cuda):
+  # what peak_memory_in_MB measures, for the logs
+  if not disable_cuda:
+    return 'peak allocated since the last reset'
+  return 'process high-water mark, measure each setting in its own run'
+
+
+class StemFeatureCache(object):
+  """ Output of a frozen stem for every sample, kept in RAM or in a memmap file.
+
+  Args:
+      mode (str): 'ram' or 'memmap'
+      capacity (int): number of samples that fit in the memmap
+      path (str): file backing the memmap
+  """
+  def __init__(self, mode='ram', capacity=0, path=None):
+    self.mode = mode
+    self.capacity = capacity
+    self.path = path
+    self.index = {}
+    self.store = [] if mode == 'ram' else None
+
+  def __len__(self):
+    return len(self.index)
+
+  def reset(self):
+    self.index = {}
+    if self.mode == 'ram':
+      self.store = []
+
+  def __call__(self, model, input, names):
+    # stem features (N*M, C, T, V) of the batch, the missing samples are computed and stored
+    if all(name in self.index for name in names):
+      rows = [self.index[name] for name in names]
+      if self.mode == 'ram':
+        features = torch.stack([self.store[r] for r in rows])
+      else:
+        features = torch.from_numpy(self.store[rows])
+      return features.view(-1, *features.shape[2:]).to(input.device)
+
+    with torch.no_grad():
+      features = model.stem(input)
+    per_sample = features.view(input.size(0), -1, *features.shape[1:]).cpu()
+    for name, f in zip(names, per_sample):
+      if name in self.index:
+        continue
+      if self.mode == 'ram':
+        self.index[name] = len(self.store)
+        self.store.append(f)
+      elif len(self.index) < self.capacity:
+        if self.store is None:
+          self.store = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.float32,
+                                                 shape=(self.capacity,) + tuple(f.shape))
+        self.store[len(self.index)] = f.numpy()
+        self.index[name] = len(self.index)
+    return features
+
+
+def probe_batch(dataset, size, seed, device='cpu'):
+  """ Batch of size samples of dataset drawn once with seed, e.g. the fixed
+  batch of the Hessian evaluations, so that they are comparable across epochs.
+
+  Returns:
+      input and target, on device
+  """
+  indices = np.sort(np.random.RandomState(seed).choice(len(dataset), min(size, len(dataset)), replace=False))
+  input, target, _ = torch.utils.data.default_collate([dataset[i] for i in indices])
+  return input.to(device), target.to(device)
 
 
 def save(model, model_path):
@@ -512,9 +608,17 @@ def load_checkpoint(model, optimizer, scheduler, architect, save, la_tracker,
   else:
     checkpoint = torch.load(filename,map_location=torch.device('cpu'))
 
+  primitives = checkpoint.get('primitives')
+  if primitives is not None and primitives != model.PRIMITIVES:
+    old_arch_parameters = model.arch_parameters()
+    keep = model.prune_to(primitives)
+    prune_optimizer_states(model, optimizer, architect.optimizer, old_arch_parameters, keep)
   model.load_state_dict(checkpoint['state_dict'])
   model.alphas_normal.data = checkpoint['alphas_normal']
   #model.alphas_reduce.data = checkpoint['alphas_reduce']
+  if checkpoint.get('betas_normal') is not None:
+    model.betas_normal.data = checkpoint['betas_normal']
+    model.betas_reduce.data = checkpoint['betas_reduce']
   optimizer.load_state_dict(checkpoint['optimizer'])
   architect.optimizer.load_state_dict(checkpoint['arch_optimizer'])
   la_tracker.ev = checkpoint['ev']
@@ -527,12 +631,38 @@ def load_checkpoint(model, optimizer, scheduler, architect, save, la_tracker,
   return lr
 
 
+def prune_optimizer_states(model, optimizer, arch_optimizer, old_arch_parameters, keep):
+  """ Rebuild the optimizer states after Network.prune.
+
+  The states of the removed modules are dropped and the states of the alphas
+  are shrunk to the kept candidates of every edge.
+  """
+  params = list(model.parameters())
+  alive = set(params)
+  for p in list(optimizer.state.keys()):
+    if p not in alive:
+      del optimizer.state[p]
+  optimizer.param_groups[0]['params'] = params
+
+  index = None
+  for old, new in zip(old_arch_parameters, model.arch_parameters()):
+    if old is new or old not in arch_optimizer.state:
+      continue
+    state = arch_optimizer.state.pop(old)
+    if index is None:
+      index = torch.LongTensor(keep).to(old.device)
+    arch_optimizer.state[new] = {
+        k: v.gather(1, index) if torch.is_tensor(v) and v.shape == old.shape else v
+        for k, v in state.items()}
+  arch_optimizer.param_groups[0]['params'] = model.arch_parameters()
+
+
 def drop_path(x, drop_prob):
   if drop_prob > 0.:
     keep_prob = 1.-drop_prob
-    mask = Variable(torch.cuda.FloatTensor(x.size(0), 1, 1, 1).bernoulli_(keep_prob))
-    x.div_(keep_prob)
-    x.mul_(mask)
+    mask = Variable(x.new_empty(x.size(0), 1, 1, 1).bernoulli_(keep_prob))
+    # out of place, x can be a relu output saved for backward
+    x = x.div(keep_prob).mul(mask)
   return x
 
 